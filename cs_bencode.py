@@ -13,127 +13,228 @@ from io import StringIO, BytesIO
 import array, numbers, sys
 from io import BytesIO
 
-def _read_byte(s):
-    return s.read(1)
-
-def _read_int(s, terminator=None, init_data=None):
-    int_chrs = init_data or []
-    while True:
-        c = _read_byte(s)
-        if not (c.isdigit() or c == b'-') or c == terminator or not c:
-            break
-        else:
-            int_chrs.append(c)
-    return int(b''.join(int_chrs))
-
-
-def _read_bytes(s, n):
-    data = BytesIO()
-    cnt = 0
-    while cnt < n:
-        m = s.read(n - cnt)
-        if not m:
-            raise Exception("Invalid bytestring, unexpected end of input.")
-        data.write(m)
-        cnt += len(m)
-    data.flush()
-    # Taking into account that Python3 can't decode strings
-    try:
-        ret = data.getvalue().decode("UTF-8")
-    except AttributeError:
-        ret = data.getvalue()
-    return ret
-
-
-def _read_delimiter(s):
-    d = _read_byte(s)
-    if d.isdigit():
-        d = _read_int(s, ":", [d])
-    return d
-
-
-def _read_list(s):
-    data = []
-    while True:
-        datum = _read_datum(s)
-        if datum is None:
-            break
-        data.append(datum)
-    return data
-
-
-def _read_map(s):
-    i = iter(_read_list(s))
-    return dict(zip(i, i))
-
-
-_read_fns = {b"i": _read_int,
-             b"l": _read_list,
-             b"d": _read_map,
-             b"e": lambda _: None,
-             # EOF
-             None: lambda _: None}
-
-
-def _read_datum(s):
-    delim = _read_delimiter(s)
-    if delim != b'':
-        return _read_fns.get(delim, lambda s: _read_bytes(s, delim))(s)
-
-
-def _write_datum(x, out):
-    if isinstance(x, (str, bytes)):
-        # x = x.encode("UTF-8")
-        # TODO revisit encodings, this is surely not right. Python
-        # (2.x, anyway) conflates bytes and strings, but 3.x does not...
-        out.write(str(len(x.encode('utf-8'))).encode('utf-8'))
-        out.write(b":")
-        out.write(x.encode('utf-8'))
+class Incomplete(Exception):
+    """
+    Buffer ends in the middle of a datum. `need` is buffer length required to make progress
+    """
+    def __init__(self, need):
+        self.need = need
+
+class Oversized(Exception):
+    """
+    String at `pos` is longer than Decoder.max_string and hasn’t fully arrived yet
+    """
+    def __init__(self, pos, colon, end):
+        self.pos = pos
+        self.colon = colon
+        self.end = end
+
+class Truncated(str):
+    """
+    String cut to Decoder.max_string bytes. `size` is its original length in bytes
+    """
+    size = 0
+
+def _decode_datum(buf, view, pos, decoder = None):
+    """
+    Decodes one datum starting at `pos` of `buf` (bytearray), returns (value, end).
+    `view` is memoryview over `buf`, strings are decoded straight from it.
+    Returns (None, end) for 'e' (end of list/dict)
+    """
+    if pos >= len(buf):
+        raise Incomplete(pos + 1)
+    c = buf[pos]
+    if 0x30 <= c <= 0x39: # 0-9
+        colon = buf.find(b':', pos)
+        if colon < 0:
+            raise Incomplete(len(buf) + 1)
+        end = colon + 1 + int(buf[pos:colon])
+        if decoder is not None and decoder.max_string:
+            max_string = decoder.max_string
+            if end - colon - 1 > max_string:
+                if end <= len(buf):
+                    res = Truncated(str(view[colon + 1:colon + 1 + max_string], 'utf-8', 'ignore'))
+                    res.size = end - colon - 1
+                    return res, end
+                if len(buf) >= colon + 1 + max_string:
+                    raise Oversized(pos, colon, end)
+                raise Incomplete(colon + 1 + max_string)
+            if end <= len(buf) and (size := decoder.truncated.get(pos)):
+                res = Truncated(str(view[colon + 1:end], 'utf-8', 'ignore'))
+                res.size = size
+                return res, end
+        if end > len(buf):
+            raise Incomplete(end)
+        return str(view[colon + 1:end], 'utf-8'), end
+    elif c == 0x69: # i
+        e = buf.find(b'e', pos)
+        if e < 0:
+            raise Incomplete(len(buf) + 1)
+        return int(buf[pos + 1:e]), e + 1
+    elif c == 0x6C: # l
+        data = []
+        pos += 1
+        while True:
+            datum, pos = _decode_datum(buf, view, pos, decoder)
+            if datum is None:
+                return data, pos
+            data.append(datum)
+    elif c == 0x64: # d
+        data = {}
+        pos += 1
+        while True:
+            key, pos = _decode_datum(buf, view, pos, decoder)
+            if key is None:
+                return data, pos
+            data[key], pos = _decode_datum(buf, view, pos, decoder)
+    elif c == 0x65: # e
+        return None, pos + 1
+    else:
+        raise Exception("Invalid bencode, unexpected byte {!r} at {}".format(chr(c), pos))
+
+def _decode_head(buf, pos, end):
+    """
+    Keys and values of dict at `pos` that are complete before `end`
+    """
+    res = {}
+    if pos < len(buf) and buf[pos] == 0x64: # d
+        pos += 1
+        with memoryview(buf) as view:
+            try:
+                while pos < end:
+                    key, pos = _decode_datum(buf, view, pos)
+                    if key is None or pos >= end:
+                        break
+                    value, pos = _decode_datum(buf, view, pos)
+                    if pos > end:
+                        break
+                    res[key] = value
+            except Incomplete:
+                pass
+    return res
+
+class Decoder:
+    """
+    Incremental decoder. Feed it bytes as they arrive, get complete messages back.
+    Incomplete tail is kept in a growable buffer until the rest arrives.
+    With max_string, longer strings are returned as Truncated, and the rest
+    of their bytes is dropped as it arrives instead of being buffered.
+    on_oversized is called with keys decoded so far (e.g. 'id') as soon as
+    such a string is first seen, before the rest of it arrives
+    """
+    def __init__(self, max_string = 0, on_oversized = None):
+        self.buffer = bytearray()
+        self.need = 0
+        self.max_string = max_string
+        self.on_oversized = on_oversized
+        self.truncated = {} # buffer pos -> original size, for strings cut in buffer
+        self.skip = 0 # bytes of truncated string yet to arrive
+
+    def feed(self, data):
+        """
+        Appends data, returns list of messages completed by it
+        """
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            self.skip -= skipped
+            data = data[skipped:]
+        buf = self.buffer
+        buf += data
+        if len(buf) < self.need:
+            return []
+        msgs = []
+        pos = 0
+        while True:
+            oversized = None
+            with memoryview(buf) as view:
+                while pos < len(buf):
+                    try:
+                        msg, pos = _decode_datum(buf, view, pos, self)
+                    except Incomplete as e:
+                        self.need = e.need - pos
+                        break
+                    except Oversized as e:
+                        oversized = e
+                        break
+                    if msg is not None:
+                        msgs.append(msg)
+                else:
+                    self.need = 0
+            if not oversized:
+                break
+            if self.on_oversized:
+                self.on_oversized(_decode_head(buf, pos, oversized.pos))
+            # keep first max_string bytes, rewrite length prefix, then decode again
+            start = oversized.colon + 1
+            self.skip = oversized.end - len(buf)
+            self.truncated[oversized.pos] = oversized.end - start
+            del buf[start + self.max_string:]
+            buf[oversized.pos:start] = b'%d:' % self.max_string
+        del buf[:pos]
+        if self.truncated:
+            self.truncated = {p - pos: size for p, size in self.truncated.items() if p >= pos}
+        return msgs
+
+def _encode_datum(x, parts):
+    """
+    Appends bencoded x to parts (list of bytes)
+    """
+    if isinstance(x, str):
+        x = x.encode('utf-8')
+        parts.append(b'%d:' % len(x))
+        parts.append(x)
+    elif isinstance(x, bytes):
+        parts.append(b'%d:' % len(x))
+        parts.append(x)
     elif isinstance(x, numbers.Integral):
-        out.write(b"i")
-        out.write(str(x).encode('utf-8'))
-        out.write(b"e")
+        parts.append(b'i' + str(x).encode('utf-8') + b'e')
     elif isinstance(x, (list, tuple)):
-        out.write(b"l")
+        parts.append(b'l')
         for v in x:
-            _write_datum(v, out)
-        out.write(b"e")
+            _encode_datum(v, parts)
+        parts.append(b'e')
     elif isinstance(x, dict):
-        out.write(b"d")
+        parts.append(b'd')
         for k, v in x.items():
-            _write_datum(k, out)
-            _write_datum(v, out)
-        out.write(b"e")
-    out.flush()
+            _encode_datum(k, parts)
+            _encode_datum(v, parts)
+        parts.append(b'e')
 
 
 def encode(v):
-    "bencodes the given value, may be a string, integer, list, or dict."
-    s = BytesIO()
-    _write_datum(v, s)
-    return s.getvalue().decode('utf-8')
+    "bencodes the given value, may be a string, integer, list, or dict. Returns bytes"
+    parts = []
+    _encode_datum(v, parts)
+    return b''.join(parts)
 
 
 def decode_file(file):
-    while True:
-        x = _read_datum(file)
-        if x is None:
-            break
-        yield x
+    decoder = Decoder()
+    while data := file.read(65536):
+        yield from decoder.feed(data)
 
 
 def decode(string):
-    "Generator that yields decoded values from the input string."
-    return decode_file(BytesIO(string.encode('utf-8')))
+    "Generator that yields decoded values from the input string or bytes."
+    if isinstance(string, str):
+        string = string.encode('utf-8')
+    return decode_file(BytesIO(string))
 
 
 class BencodeIO(object):
     def __init__(self, file, on_close=None):
         self._file = file
         self._on_close = on_close
+        self._decoder = Decoder()
+        self._pending = []
 
     def read(self):
-        return _read_datum(self._file)
+        while not self._pending:
+            data = self._file.read(65536)
+            if not data:
+                return None
+            self._pending = self._decoder.feed(data)
+        return self._pending.pop(0)
 
     def __iter__(self):
         return self
@@ -152,7 +253,7 @@ class BencodeIO(object):
         return v
 
     def write(self, v):
-        return _write_datum(v, self._file)
+        return self._file.write(encode(v))
 
     def flush(self):
         if self._file.flush:
@@ -182,7 +283,7 @@ if __name__ == '__main__':
         try:
             parsed = json.loads(line)
             encoded = encode(parsed)
-            # print("SND RAW", encoded.encode())
-            conn.sendall(encoded.encode())
+            # print("SND RAW", encoded)
+            conn.sendall(encoded)
         except json.JSONDecodeError:
             print("Not a valid JSON")
@@ -58,7 +58,7 @@ def indent_lines(view, regions, edit):
 
 def newline_indent(view, point):
     text = view.substr(sublime.Region(0, point))
-    parsed = cs_parser.parse(text)
+    parsed = cs_parser.parse_tree(view, sublime.Region(0, point))
     to_close = []
     node = parsed
     start = node.children[-1].start if node.children else 0
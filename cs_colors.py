@@ -1,9 +1,7 @@
-import re, sublime
+import collections, functools, re, sublime, sublime_plugin
 
 RE_REPLACE_GLOB = re.compile(r"\*\*|[\*\?\.\(\)\[\]\{\}\$\^\+\|]")
 
-region_id = 0
-
 # Colors
 FG_ANSI = {
   30: 'black',
@@ -60,56 +58,128 @@ SCOPES = {
   'light_cyan':    'cyanish'
 }
 
-RE_UNKNOWN_ESCAPES = re.compile(r"\x1b[^a-zA-Z]*[a-zA-Z]")
-RE_COLOR_ESCAPES = re.compile(r"\x1b\[((?:;?\d+)*)m")
+RE_ESCAPES = re.compile(r"\x1b(?:\[([;\d]*)m|[^a-zA-Z]*[a-zA-Z])") # group 1 is set for colors
 RE_NOTSPACE = re.compile(r"[^\s]+")
 
-def write(view, characters):
-  decolorized = ""
-  original_pos = 0
-  decolorized_pos = 0
-  fg = "default"
-  bg = "default"
-  regions = []
-  def iteration(start, end, group):
-      nonlocal decolorized, original_pos, decolorized_pos, fg, bg, regions
-      text = characters[original_pos:start]
-      text = RE_UNKNOWN_ESCAPES.sub("", text)
-      decolorized += text
-      if len(text) > 0 and (fg != "default" or bg != "default"):
-          regions.append({"text":  text,
-                          "start": decolorized_pos,
-                          "end":   decolorized_pos + len(text),
-                          "fg":    fg,
-                          "bg":    bg})
-      digits = re.findall(r"\d+", group) or ["0"]
-      for digit in digits:
-          digit = int(digit)
-          if digit in FG_ANSI:
-              fg = FG_ANSI[digit]
-          if digit in BG_ANSI:
-              bg = BG_ANSI[digit]
-          if digit == 0:
-              fg = 'default'
-              bg = 'default'
-      original_pos = end
-      decolorized_pos += len(text)
-
-  for m in RE_COLOR_ESCAPES.finditer(characters):
-      iteration(m.start(), m.end(), m.group(1))
-  iteration(len(characters), len(characters), "")
+@functools.lru_cache(maxsize = 1024)
+def sgr(fg, bg, params):
+  """
+  Applies Select Graphic Rendition params ("1;31") to current colors,
+  returns (fg, bg, scope). Memoized: output repeats the same few transitions,
+  but params of 256-color and RGB escapes are unbounded
+  """
+  for digit in (params.split(';') if params else ['0']):
+      if not digit:
+          continue
+      digit = int(digit)
+      if digit in FG_ANSI:
+          fg = FG_ANSI[digit]
+      if digit in BG_ANSI:
+          bg = BG_ANSI[digit]
+      if digit == 0:
+          fg = 'default'
+          bg = 'default'
+  return (fg, bg, SCOPES.get(bg, None) or SCOPES.get(fg, None))
+
+def decolorize(characters):
+  """
+  Strips escape sequences in one pass. Returns (text, spans), where
+  spans is {scope: [(start, end), ...]}, one span per colored word of text
+  """
+  # [text, params, text, params, ..., text], params are None for non-color escapes
+  pieces = RE_ESCAPES.split(characters)
+  text = ''.join(pieces[::2])
+  runs = [] # [(scope, start, end)], adjacent runs with same scope merged
+  fg, bg, scope = 'default', 'default', None
+  length = len(pieces[0])
+  for i in range(1, len(pieces), 2):
+      if (params := pieces[i]) is not None:
+          fg, bg, scope = sgr(fg, bg, params)
+      if (piece_len := len(pieces[i + 1])) and scope:
+          if runs and runs[-1][0] == scope and runs[-1][2] == length:
+              runs[-1] = (scope, runs[-1][1], length + piece_len)
+          else:
+              runs.append((scope, length, length + piece_len))
+      length += piece_len
+  spans = collections.defaultdict(list)
+  for scope, start, end in runs:
+      spans[scope].extend(m.span() for m in RE_NOTSPACE.finditer(text, start, end))
+  return text, spans
+
+class Buckets:
+  """
+  Regions of one scope in one view, spread over keys of at most bucket_size
+  regions each. Appending re-sets only the last key, not every region of the panel
+  """
+  bucket_size = 1000
+
+  def __init__(self, scope):
+      self.scope = scope
+      self.first = 0 # earlier keys were emptied by erase
+      self.last = 0
+      self.regions = [] # regions of last key
+
+  def key(self, i):
+      return region_key(self.scope) + '#' + str(i)
+
+  def append(self, view, regions):
+      for region in regions:
+          if len(self.regions) >= self.bucket_size:
+              view.add_regions(self.key(self.last), self.regions, 'region.' + self.scope)
+              self.last += 1
+              self.regions = []
+          self.regions.append(region)
+      view.add_regions(self.key(self.last), self.regions, 'region.' + self.scope)
 
+  def compact(self, view):
+      """
+      Drops regions collapsed by erase, rereads positions of the rest
+      """
+      for i in range(self.first, self.last + 1):
+          key = self.key(i)
+          if regions := [r for r in view.get_regions(key) if not r.empty()]:
+              view.add_regions(key, regions, 'region.' + self.scope)
+          else:
+              view.erase_regions(key)
+              if i == self.first and i < self.last:
+                  self.first += 1
+          if i == self.last:
+              self.regions = regions
+
+buckets = {} # Dict[view id, Dict[scope, Buckets]]
+
+def write(view, characters):
+  text, spans = decolorize(characters)
   insertion_point = view.size()
-  view.run_command('append', {'characters': decolorized, 'force': True, 'scroll_to_end': True})
-  
-  global region_id
-  for region in regions:
-      if scope := SCOPES.get(region['bg'], None) or SCOPES.get(region['fg'], None):
-          for m in RE_NOTSPACE.finditer(region['text']):
-              start = insertion_point + region['start'] + m.start()
-              end = start + len(m.group(0))
-              region_id += 1
-              view.add_regions(
-                          "executor#{}".format(region_id),
-                          [sublime.Region(start, end)],
-                          'region.' + scope)
+  view.run_command('append', {'characters': text, 'force': True, 'scroll_to_end': True})
+  view_buckets = buckets.setdefault(view.id(), {})
+  for scope, scope_spans in spans.items():
+      if (scope_buckets := view_buckets.get(scope)) is None:
+          scope_buckets = view_buckets[scope] = Buckets(scope)
+      scope_buckets.append(view, [sublime.Region(insertion_point + start, insertion_point + end) for start, end in scope_spans])
+
+def region_key(scope):
+  return "executor#" + scope
+
+def erase(view, edit, end):
+  """
+  Erases [0, end) from view, together with colors of erased text
+  """
+  view.erase(edit, sublime.Region(0, end))
+  if view.size() == 0:
+      forget(view)
+  else:
+      for scope_buckets in buckets.get(view.id(), {}).values():
+          scope_buckets.compact(view)
+
+def forget(view):
+  """
+  Erases all color regions of view and drops its buckets
+  """
+  for scope_buckets in buckets.pop(view.id(), {}).values():
+      for i in range(scope_buckets.first, scope_buckets.last + 1):
+          view.erase_regions(scope_buckets.key(i))
+
+class EventListener(sublime_plugin.EventListener):
+  def on_close(self, view):
+      buckets.pop(view.id(), None)
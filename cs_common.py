@@ -1,4 +1,4 @@
-import collections, html, math, os, re, socket, sublime, sublime_plugin, time, traceback
+import bisect, collections, html, math, os, re, socket, sublime, sublime_plugin, threading, time, traceback
 from typing import Any, Dict, Tuple
 
 ns = 'clojure-sublimed'
@@ -84,6 +84,18 @@ def debug(format, *args):
     if setting('debug'):
         print('[ Clojure Sublimed ]', format.format(*args))
 
+def info(format, *args):
+    """
+    Print to console. Format as in `str.format`
+    """
+    print('[ Clojure Sublimed ]', format.format(*args))
+
+def warn(format, *args):
+    """
+    Print warning to console. Format as in `str.format`
+    """
+    print('[ Clojure Sublimed ] WARNING:', format.format(*args))
+
 def error(format, *args):
     """
     Print error and stacktrace to console. Format as in `str.format`
@@ -128,6 +140,102 @@ def regions_touch(r1, r2):
     """
     return r1 != None and r2 != None and not r1.end() < r2.begin() and not r1.begin() > r2.end()
 
+class RegionIndex:
+    """
+    Non-overlapping regions of one view (evals or watches) sorted by position,
+    so point and range lookups are O(log n) instead of asking view for each region.
+    Items must have region_key(). Follows edits through shift().
+    Used from UI, event loop and progress threads, so every method takes
+    the lock and lookups return copies
+    """
+    def __init__(self):
+        self.lock   = threading.Lock()
+        self.begins = []
+        self.ends   = [] # sorted too, because regions don’t overlap
+        self.items  = []
+
+    def add(self, item, region):
+        with self.lock:
+            i = bisect.bisect_left(self.begins, region.begin())
+            while i < len(self.items) and self.begins[i] == region.begin() and self.ends[i] < region.end():
+                i += 1
+            self.begins.insert(i, region.begin())
+            self.ends.insert(i, region.end())
+            self.items.insert(i, item)
+
+    def remove(self, item):
+        with self.lock:
+            self._remove(item)
+
+    def _remove(self, item):
+        for i, x in enumerate(self.items):
+            if x is item:
+                del self.begins[i], self.ends[i], self.items[i]
+                return
+
+    def find(self, region):
+        """
+        Returns [(item, region)] for regions intersecting or touching region
+        """
+        with self.lock:
+            lo = bisect.bisect_left(self.ends, region.begin())
+            hi = bisect.bisect_right(self.begins, region.end())
+            return [(self.items[i], sublime.Region(self.begins[i], self.ends[i])) for i in range(lo, hi)]
+
+    def region(self, item):
+        """
+        Current region of item, None if it’s not in index
+        """
+        with self.lock:
+            for i, x in enumerate(self.items):
+                if x is item:
+                    return sublime.Region(self.begins[i], self.ends[i])
+
+    def regions(self):
+        with self.lock:
+            return [(item, sublime.Region(b, e)) for item, b, e in zip(self.items, self.begins, self.ends)]
+
+    def shift(self, view, changes):
+        """
+        Applies changes [(a, b, delta)], in order. Regions after a change move by delta,
+        regions touching it are read from view after all changes are applied,
+        to match how Sublime adjusts them. Call synchronously from on_text_changed
+        """
+        with self.lock:
+            self._shift(view, changes)
+
+    def _shift(self, view, changes):
+        begins, ends, items = self.begins, self.ends, self.items
+        touched = []
+        for a, b, delta in changes:
+            lo = bisect.bisect_left(ends, a)
+            hi = bisect.bisect_right(begins, b)
+            touched.extend(items[lo:hi])
+            limit = b + delta # new end of changed text
+            for i in range(lo, len(items)):
+                for points in (begins, ends):
+                    p = points[i]
+                    points[i] = p + delta if p >= b else min(p, limit) if p > a else p
+        for item in touched:
+            if regions := view.get_regions(item.region_key()):
+                for i, x in enumerate(items):
+                    if x is item:
+                        begins[i], ends[i] = regions[0].begin(), regions[0].end()
+                        break
+            else:
+                self._remove(item)
+        if touched and any(begins[i] > begins[i + 1] or ends[i] > ends[i + 1] for i in range(len(begins) - 1)):
+            order = sorted(range(len(items)), key = lambda i: (begins[i], ends[i]))
+            self.begins = [begins[i] for i in order]
+            self.ends   = [ends[i] for i in order]
+            self.items  = [items[i] for i in order]
+
+def changes_deltas(changes):
+    """
+    TextChange list to [(a, b, delta)] for RegionIndex.shift
+    """
+    return [(c.a.pt, c.b.pt, len(c.str) - (c.b.pt - c.a.pt)) for c in changes]
+
 def basic_styles(view):
     """
     Used to format phantoms, to achieve ~line height as in the main editor
@@ -155,6 +263,72 @@ def get_default(d, k, default):
 def escape(value):
     return html.escape(value).replace("\t", "  ").replace(" ", " ")
 
+class PhantomText:
+    """
+    Formatted phantom text, rendered to HTML lazily, one page of lines
+    at a time. Rendered lines are kept, so expanding or toggling again
+    doesn't wrap and escape them twice. Text is either a string or
+    an iterator of lines, which is only advanced as far as rendered
+    """
+    def __init__(self, text, wrap_fn):
+        if text is None or isinstance(text, str):
+            self.lines = text.splitlines() if text else []
+            self.rest  = None
+        else:
+            self.lines = []
+            self.rest  = iter(text)
+        self.wrap_fn = wrap_fn
+        self.html    = []
+
+    def pull(self, count):
+        """
+        Makes sure first `count` lines are in self.lines, if text has that many
+        """
+        while self.rest is not None and len(self.lines) < count:
+            if (line := next(self.rest, None)) is None:
+                self.rest = None
+            else:
+                self.lines.append(line)
+
+    def is_empty(self):
+        self.pull(1)
+        return not self.lines
+
+    def render(self, count):
+        """
+        HTML of first `count` lines, plus 'more' link if there are any left
+        """
+        self.pull(count + 1)
+        for line in self.lines[len(self.html):count]:
+            self.html.append("<p>" + escape(self.wrap_fn(line)) + "</p>")
+        body = "".join(self.html[:count])
+        if self.rest is not None:
+            body += "<p><a href='more'>more lines…</a></p>"
+        elif (rest := len(self.lines) - count) > 0:
+            body += f"<p><a href='more'>{rest} more line{'s' if rest > 1 else ''}…</a></p>"
+        return body
+
+def add_text_phantom(view, key, point, styles, text, count = None, on_more = None):
+    """
+    Adds phantom with first `count` lines of PhantomText. Clicking 'more'
+    calls on_more(count) with a bigger count, so that caller can replace
+    phantom with a longer one
+    """
+    if not (page := setting('phantom_lines', 100)):
+        text.pull(math.inf)
+        page = len(text.lines)
+    count = count or page
+    body = f"""<body id='clojure-sublimed'>
+        { basic_styles(view) }
+        { styles }
+    </style>"""
+    body += text.render(count)
+    body += "</body>"
+    def on_navigate(href):
+        if href == 'more' and on_more:
+            on_more(count + page)
+    return view.add_phantom(key, sublime.Region(point, point), body, sublime.LAYOUT_BLOCK, on_navigate)
+
 colors: Dict[str, Tuple[str, str]] = {}
 
 def scope_color(view, scope):
@@ -215,24 +389,6 @@ def find_in_folders(name = None, pred = None):
                     if pred(folder + '/' + file):
                         return path
 
-class SocketIO:
-    """
-    Simple buffered interface around socket that let you read N bytes at a time
-    """
-    def __init__(self, socket):
-        self.socket = socket
-        self.buffer = None
-        self.pos = -1
-
-    def read(self, n):
-        if not self.buffer or self.pos >= len(self.buffer):
-            self.buffer = self.socket.recv(4096)
-            self.pos = 0
-        begin = self.pos
-        end = min(begin + n, len(self.buffer))
-        self.pos = end
-        return self.buffer[begin:end]
-
 def socket_connect(addr):
     if match := re.fullmatch(r'\s*([^:]+):(\d+)\s*', addr):
         host, port = match.groups()
@@ -78,7 +78,7 @@ class Connection:
     def code(self, view, selected_region, eval_region, transform_fn = None):
         code = view.substr(eval_region)
         ns = cs_parser.namespace(view, eval_region.begin()) or 'user'
-        parsed = cs_parser.parse(view.substr(eval_region))
+        parsed = cs_parser.parse_tree(view, eval_region)
         forms = [child for child in parsed.children if child.name not in {'comment', 'discard'}]
         
         if transform_fn:
@@ -114,6 +114,12 @@ class Connection:
                     print_quota = print_quota)
             self.eval_impl(form)
 
+    def eval_forms(self, view, regions, on_finish = None):
+        """
+        Eval top-level forms at regions, in order, each with its own result
+        """
+        self.eval(view, regions, on_finish = on_finish)
+
     def eval_status(self, code, ns):
         eval = cs_eval_status.StatusEval(code)
         form = cs_common.Form(id = eval.id, code = code, ns = ns)
@@ -167,6 +173,7 @@ class Connection:
         state.conn = None
         cs_common.set_status(self.window, status_key, None)
         cs_eval.erase_evals(lambda eval: eval.window == self.window)
+        cs_eval.forget_evaluated(self.window)
         cs_warn.reset_warnings(self.window)
 
     def set_status(self, phase, message, *args):
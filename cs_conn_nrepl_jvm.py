@@ -1,5 +1,41 @@
-import os, sublime, sublime_plugin
-from . import cs_common, cs_conn, cs_conn_nrepl_raw, cs_eval
+import collections, os, statistics, sublime, sublime_plugin, threading, time
+from . import cs_bencode, cs_common, cs_conn, cs_conn_nrepl_raw, cs_eval
+
+class SessionPool:
+    """
+    Long-lived sessions cloned from connection session. Each eval leases one
+    for its duration, so evals run in parallel without cloning a session each time
+    """
+    def __init__(self):
+        self.lock   = threading.Lock()
+        self.free   = [] # session ids
+        self.leases = {} # eval id -> session id
+
+    def add(self, session):
+        with self.lock:
+            self.free.append(session)
+
+    def lease(self, id):
+        """
+        Returns session for eval id, None if all sessions are busy
+        """
+        with self.lock:
+            if self.free:
+                session = self.leases[id] = self.free.pop()
+                return session
+
+    def release(self, id, reuse = True):
+        """
+        Ends lease of eval id. With reuse = False, session is dropped from pool
+        """
+        with self.lock:
+            if (session := self.leases.pop(id, None)) is not None and reuse:
+                self.free.append(session)
+            return session
+
+    def sessions(self):
+        with self.lock:
+            return self.free + list(self.leases.values())
 
 class ConnectionNreplJvm(cs_conn_nrepl_raw.ConnectionNreplRaw):
     """
@@ -8,6 +44,11 @@ class ConnectionNreplJvm(cs_conn_nrepl_raw.ConnectionNreplRaw):
     def __init__(self, addr):
         super().__init__(addr)
         self.eval_op = 'clone-eval-close'
+        self.pool    = SessionPool()
+        self.pristine = None # session pool sessions are cloned from, never evaluates anything
+        self.clones  = 0 # pool sessions requested so far
+        self.timings = {} # eval id -> (mode, time sent)
+        self.round_trips = collections.defaultdict(lambda: collections.deque(maxlen = 1000)) # mode -> ms
 
     def send(self, msg):
         if self.ready():
@@ -19,10 +60,49 @@ class ConnectionNreplJvm(cs_conn_nrepl_raw.ConnectionNreplRaw):
                 del msg['nrepl.middleware.print/quota']
         super().send(msg)
 
-    def eval_impl(self, form):
+    def fill_pool(self):
+        for _ in range(cs_common.setting('nrepl_session_pool', 0)):
+            self.clone_pool_session()
+
+    def clone_pool_session(self):
+        """
+        Pool sessions are cloned from pristine session, a copy of connection session
+        taken right after eval_shared. Connection session itself runs batches,
+        so its bindings change over time
+        """
+        self.clones += 1
+        self.send({'id':      f'pool.{self.clones}',
+                   'session': self.pristine,
+                   'op':      'clone'})
+
+    def on_eval_done(self, id):
+        if timing := self.timings.pop(id, None):
+            mode, sent = timing
+            self.round_trips[mode].append((time.perf_counter() - sent) * 1000)
+        reset = cs_common.setting('nrepl_session_pool_reset', True)
+        if (session := self.pool.release(id, reuse = not reset)) and reset:
+            self.send({'op': 'close', 'session': session})
+            self.clone_pool_session()
+
+    def disconnect_impl(self):
+        if self.channel and self.session:
+            for session in self.pool.sessions() + ([self.pristine] if self.pristine else []):
+                self.send({'op': 'close', 'session': session})
+        self.timings.clear()
+        super().disconnect_impl()
+
+    def eval_impl(self, form, op = None):
+        op = op or self.eval_op
+        session = self.session
+        if op == 'clone-eval-close' and (leased := self.pool.lease(form.id)):
+            # when pool is exhausted, fall back to clone-eval-close
+            op, session = 'eval', leased
+            if eval := cs_eval.by_id(form.id):
+                eval.session = leased
+        self.timings[form.id] = ('pool' if session != self.session else op, time.perf_counter())
         msg = {'id':      form.id,
-               'session': self.session,
-               'op':      self.eval_op,
+               'session': session,
+               'op':      op,
                'code':    form.code,
                'ns':      form.ns}
         if (line := form.line) is not None:
@@ -36,6 +116,7 @@ class ConnectionNreplJvm(cs_conn_nrepl_raw.ConnectionNreplRaw):
         self.send(msg)
 
     def interrupt_impl(self, batch_id, id):
+        self.cancel_batch(batch_id)
         eval = cs_eval.by_id(id)
         msg = {'session':      eval.session or self.session,
                'op':           'interrupt',
@@ -86,7 +167,23 @@ class ConnectionNreplJvm(cs_conn_nrepl_raw.ConnectionNreplRaw):
             return True
 
         elif 5 == msg.get('id') and 'done' in msg.get('status', []):
+            if cs_common.setting('nrepl_session_pool', 0):
+                self.send({'id':      'pristine',
+                           'session': self.session,
+                           'op':      'clone'})
+            else:
+                self.set_status(4, self.get_addr())
+            return True
+
+        elif 'pristine' == msg.get('id') and 'new-session' in msg:
+            self.pristine = msg['new-session']
             self.set_status(4, self.get_addr())
+            self.fill_pool()
+            return True
+
+    def handle_pool_session(self, msg):
+        if 'new-session' in msg and (id := msg.get('id')) and isinstance(id, str) and id.startswith('pool.'):
+            self.pool.add(msg['new-session'])
             return True
 
     def handle_new_session(self, msg):
@@ -99,7 +196,9 @@ class ConnectionNreplJvm(cs_conn_nrepl_raw.ConnectionNreplRaw):
             time = msg.get(cs_common.ns + '.middleware/time-taken')
             if time:
                 time = time / 1000000
-            cs_eval.on_success(id, msg.get('value'), time = time)
+            value = msg.get('value')
+            truncated = isinstance(value, cs_bencode.Truncated)
+            cs_eval.on_success(id, value, time = time, truncated = truncated)
             return True
 
     def handle_exception(self, msg):
@@ -118,9 +217,11 @@ class ConnectionNreplJvm(cs_conn_nrepl_raw.ConnectionNreplRaw):
                     column = get('column')
                     text   += f" ({get('source')}:{get('line')}:{get('column')})"
                 cs_eval.on_exception(id, text, line = line, column = column, trace = get('trace'))
+                self.timings.pop(id, None)
+                return True
+            elif super().handle_exception(msg):
+                self.timings.pop(id, None)
                 return True
-            else:
-                return super().handle_exception(msg)
 
     def handle_msg(self, msg):
         cs_common.debug('RCV {}', msg)
@@ -128,8 +229,12 @@ class ConnectionNreplJvm(cs_conn_nrepl_raw.ConnectionNreplRaw):
         for key in msg.get('nrepl.middleware.print/truncated-keys', []):
             msg[key] += ' ...'
 
+        if 'done' in msg.get('status', []):
+            self.on_eval_done(msg.get('id'))
+
         self.handle_connect(msg) \
         or self.handle_disconnect(msg) \
+        or self.handle_pool_session(msg) \
         or self.handle_new_session(msg) \
         or self.handle_value(msg) \
         or self.handle_exception(msg) \
@@ -151,3 +256,18 @@ class ClojureSublimedConnectNreplJvmCommand(sublime_plugin.WindowCommand):
     def is_enabled(self):
         state = cs_common.get_state(self.window)
         return state.conn is None
+
+class ClojureSublimedNreplRoundTripsCommand(sublime_plugin.WindowCommand):
+    """
+    Reports median time from sending an eval to receiving done, by the way session was obtained
+    """
+    def run(self):
+        state = cs_common.get_state(self.window)
+        stats = [f'{mode} {statistics.median(times):.1f} ms ({len(times)} evals)' for mode, times in state.conn.round_trips.items() if times]
+        message = 'Eval round trip, median: ' + (', '.join(stats) or 'no evals yet')
+        cs_common.info('{}', message)
+        self.window.status_message(message)
+
+    def is_enabled(self):
+        state = cs_common.get_state(self.window)
+        return isinstance(state.conn, ConnectionNreplJvm)
@@ -1,5 +1,18 @@
-import os, sublime, sublime_plugin, threading
-from . import cs_bencode, cs_colors, cs_common, cs_conn, cs_eval
+import collections, os, sublime, sublime_plugin, threading
+from . import cs_bencode, cs_colors, cs_common, cs_conn, cs_eval, cs_loop, cs_parser
+
+output_interval = 50 # ms, how often buffered out/err is flushed to output panel
+batch_window    = 16 # how many forms of a batch are sent without waiting for results
+
+class Batch:
+    """
+    Top-level forms of a multi-form eval. Evaluated one by one in connection session,
+    up to batch_window forms are sent ahead so nREPL never waits for the next one
+    """
+    def __init__(self, id, forms):
+        self.id       = id
+        self.forms    = collections.deque(forms) # cs_common.Form, not sent yet
+        self.inflight = set() # ids sent but not done
 
 class ConnectionNreplRaw(cs_conn.Connection):
     """
@@ -8,47 +21,62 @@ class ConnectionNreplRaw(cs_conn.Connection):
     def __init__(self, addr):
         super().__init__()
         self.addr        = addr
-        self.socket      = None
-        self.reader      = None
+        self.channel     = None
+        self.decoder     = None
         self.session     = None
         self.closing     = False
         self.eval_op     = 'eval'
         self.output_view = None
+        self.output      = [] # pending out/err strings, guarded by output_lock
+        self.output_lock = threading.Lock()
+        self.output_sizes = {} # eval id -> characters of out/err written so far
+        self.interrupted = set() # eval ids interrupted for going over value_budget
+        self.batches     = {} # Dict[int, Batch], guarded by batch_lock
+        self.batch_lock  = threading.Lock()
 
     def connect_impl(self):
         self.set_status(0, 'Connecting to {}...', self.get_addr())
-        self.socket = cs_common.socket_connect(self.get_addr())
-        self.reader = threading.Thread(daemon=True, target=self.read_loop)
-        self.reader.start()
+        socket = cs_common.socket_connect(self.get_addr())
+        self.decoder = cs_bencode.Decoder(max_string = cs_common.setting('value_budget', 1000000),
+                                          on_oversized = self.on_oversized)
+        self.channel = cs_loop.register(socket, self.on_data, self.on_close)
+        self.set_status(1, 'Cloning session')
+        self.send({'op': 'clone', 'id': 1})
 
     def disconnect_impl(self):
-        if self.socket:
+        if self.channel:
             if self.session:
                 self.send({'op': 'close', 'session': self.session})
             else:
-                self.socket.close()
-                self.socket = None
-
-    def read_loop(self):
-        try:
-            self.set_status(1, 'Cloning session')
-            self.send({'op': 'clone', 'id': 1})
-            for msg in cs_bencode.decode_file(cs_common.SocketIO(self.socket)):
-                self.handle_msg(msg)
-        except OSError:
-            if self.socket:
-                self.socket.close()
-                self.socket = None
+                self.channel.close()
+                self.channel = None
+
+    def on_data(self, data):
+        """
+        Called on event loop thread
+        """
+        for msg in self.decoder.feed(data):
+            self.handle_msg(msg)
+
+    def on_oversized(self, msg):
+        """
+        Called on event loop thread when a string over value_budget starts arriving
+        """
+        if id := msg.get('id'):
+            self.interrupt_output(id)
+
+    def on_close(self):
+        self.channel = None
         self.disconnect()
 
     def send(self, msg):
         cs_common.debug('SND {}', msg)
-        self.socket.sendall(cs_bencode.encode(msg).encode())
+        self.channel.send(cs_bencode.encode(msg))
 
-    def eval_impl(self, form):
+    def eval_impl(self, form, op = None):
         msg = {'id':      form.id,
                'session': self.session,
-               'op':      self.eval_op,
+               'op':      op or self.eval_op,
                'code':    form.code,
                'ns':      form.ns}
         if (line := form.line) is not None:
@@ -59,6 +87,82 @@ class ConnectionNreplRaw(cs_conn.Connection):
             msg['file'] = file
         self.send(msg)
 
+    def eval(self, view, sel, transform_fn = None, print_quota = None, on_finish = None):
+        """
+        With nrepl_batch_eval, selections with several top-level forms
+        are evaluated form by form, each with its own result, same as Socket REPL does
+        """
+        if transform_fn or not cs_common.setting('nrepl_batch_eval', False):
+            super().eval(view, sel, transform_fn = transform_fn, print_quota = print_quota, on_finish = on_finish)
+            return
+        for selected_region in sel:
+            eval_region = self.eval_region(selected_region, view)
+            (code, ns, forms) = self.code(view, selected_region, eval_region)
+            if len(forms) > 1:
+                start = eval_region.begin()
+                regions = [sublime.Region(start + form.start, start + form.end) for form in forms]
+                self.eval_batch(view, regions, print_quota = print_quota, on_finish = on_finish)
+            else:
+                super().eval(view, [selected_region], print_quota = print_quota, on_finish = on_finish)
+
+    def eval_forms(self, view, regions, on_finish = None):
+        self.eval_batch(view, regions, on_finish = on_finish)
+
+    def eval_batch(self, view, regions, print_quota = None, on_finish = None):
+        batch_id = cs_eval.Eval.next_id()
+        file = view.file_name()
+        batch_forms = []
+        for idx, region in enumerate(regions):
+            eval = cs_eval.Eval(view, region, id = f'{batch_id}.{idx}', batch_id = batch_id, on_finish = on_finish)
+            (line, column) = view.rowcol_utf16(region.begin())
+            batch_forms.append(cs_common.Form(
+                id     = eval.id,
+                code   = view.substr(region),
+                ns     = cs_parser.namespace(view, region.begin()) or 'user',
+                line   = line + 1,
+                column = column,
+                file   = file,
+                print_quota = print_quota))
+        with self.batch_lock:
+            batch = self.batches[batch_id] = Batch(batch_id, batch_forms)
+            self.send_batch(batch)
+
+    def send_batch(self, batch):
+        """
+        Tops up forms in flight. Forms must share one session and plain "eval" op,
+        that’s what keeps them in order. Call with batch_lock held
+        """
+        while batch.forms and len(batch.inflight) < batch_window:
+            form = batch.forms.popleft()
+            batch.inflight.add(form.id)
+            self.eval_impl(form, op = 'eval')
+        if not batch.forms and not batch.inflight:
+            del self.batches[batch.id]
+
+    def on_batch_done(self, id):
+        if isinstance(id, str) and (batch_id := id.split('.')[0]).isdigit():
+            with self.batch_lock:
+                if (batch := self.batches.get(int(batch_id))) and id in batch.inflight:
+                    batch.inflight.remove(id)
+                    self.send_batch(batch)
+
+    def cancel_batch(self, batch_id):
+        """
+        Forms not sent yet are dropped, ones in flight will still report their results
+        """
+        with self.batch_lock:
+            batch = self.batches.pop(batch_id, None)
+        if batch:
+            for form in batch.forms:
+                if eval := cs_eval.by_id(form.id):
+                    eval.erase(interrupt = False)
+
+    def load_file(self, view):
+        if cs_common.setting('nrepl_batch_eval', False):
+            self.eval(view, [sublime.Region(0, view.size())])
+        else:
+            super().load_file(view)
+
     def load_file_impl(self, id, file, path):
         msg = {'id':        id,
                'session':   self.session,
@@ -77,7 +181,20 @@ class ConnectionNreplRaw(cs_conn.Connection):
                'ns':      ns}
         self.send(msg)
 
+    def interrupt_output(self, id):
+        """
+        Value or output went over value_budget: stop the eval producing it
+        """
+        if id in self.interrupted:
+            return
+        self.interrupted.add(id)
+        eval = cs_eval.by_id(id)
+        self.send({'session':      (eval and eval.session) or self.session,
+                   'op':           'interrupt',
+                   'interrupt-id': id})
+
     def interrupt_impl(self, batch_id, id):
+        self.cancel_batch(batch_id)
         msg = {'session':      self.session,
                'op':           'interrupt',
                'interrupt-id': id}
@@ -91,19 +208,22 @@ class ConnectionNreplRaw(cs_conn.Connection):
 
     def handle_disconnect(self, msg):
         if self.session == msg.get('session') and 'session-closed' in msg.get('status', []):
-            if self.socket:
-                self.socket.close()
-                self.socket = None
+            if self.channel:
+                self.channel.close()
+                self.channel = None
             return True
 
     def handle_value(self, msg):
         if 'value' in msg and (id := msg.get('id')):
             if isinstance(id, str) and id.endswith('.e'):
-                id = int(id[:-2])
+                id = id[:-2]
+                id = int(id) if id.isdigit() else id
                 if (eval := cs_eval.by_id(id)) and eval.status == 'exception' and not eval.trace:
                     eval.trace = msg['value']
             else:
-                cs_eval.on_success(id, msg.get('value'))
+                value = msg.get('value')
+                truncated = isinstance(value, cs_bencode.Truncated)
+                cs_eval.on_success(id, value, truncated = truncated)
             return True
 
     def handle_exception(self, msg):
@@ -135,21 +255,55 @@ class ConnectionNreplRaw(cs_conn.Connection):
                 self.output_view = window.create_output_panel('repl')
         return self.output_view
 
+    def write_output(self, text, id = None):
+        """
+        Called from event loop thread. Buffers text, flush happens on UI thread
+        at most once per output_interval ms. Output of a single eval over
+        value_budget is dropped and the eval is interrupted
+        """
+        if id and (budget := cs_common.setting('value_budget', 1000000)):
+            written = self.output_sizes.get(id, 0)
+            if written > budget:
+                return
+            self.output_sizes[id] = written + len(text)
+            if written + len(text) > budget:
+                text = text[:budget - written] + '\n... output truncated\n'
+                self.interrupt_output(id)
+        with self.output_lock:
+            self.output.append(text)
+            scheduled = len(self.output) > 1
+        if not scheduled:
+            sublime.set_timeout(self.flush_output, output_interval)
+
+    def flush_output(self):
+        with self.output_lock:
+            text = ''.join(self.output)
+            self.output.clear()
+        if text:
+            if self.window.active_panel() != "output.repl":
+                self.window.run_command("show_panel", {"panel": "output.repl"})
+            view = self.get_output_view()
+            cs_colors.write(view, text)
+            max_size = cs_common.setting('output_panel_max_size', 1000000)
+            if max_size and view.size() > max_size:
+                view.run_command("clojure_sublimed_trim_output_panel", {"size": max_size * 3 // 4})
+
     def handle_out(self, msg):
         if 'out' in msg:
-            self.window.run_command("show_panel", {"panel": "output.repl"})
-            cs_colors.write(self.get_output_view(), msg['out'])
+            self.write_output(msg['out'], msg.get('id'))
             return True
 
     def handle_err(self, msg):
         if 'err' in msg:
-            self.window.run_command("show_panel", {"panel": "output.repl"})
-            cs_colors.write(self.get_output_view(), msg['err'])
+            self.write_output(msg['err'], msg.get('id'))
             return True
 
     def handle_done(self, msg):
         if (id := msg.get('id')) and (status := msg.get('status')) and 'done' in status:
             cs_eval.on_done(id)
+            self.on_batch_done(id)
+            self.output_sizes.pop(id, None)
+            self.interrupted.discard(id)
 
     def handle_msg(self, msg):
         cs_common.debug('RCV {}', msg)
@@ -181,7 +335,19 @@ class ClojureSublimedConnectNreplRawCommand(sublime_plugin.WindowCommand):
 
 class ClojureSublimedClearOutputPanelCommand(sublime_plugin.TextCommand):
     def run(self, edit):
-        self.view.erase(edit, sublime.Region(0, self.view.size()))
+        cs_colors.erase(self.view, edit, self.view.size())
+
+class ClojureSublimedTrimOutputPanelCommand(sublime_plugin.TextCommand):
+    """
+    Erases oldest output, keeping last `size` characters, starting from a new line
+    """
+    def run(self, edit, size):
+        end = self.view.size() - size
+        if end > 0:
+            line_end = self.view.find('\n', end, sublime.LITERAL)
+            if line_end and line_end.end() < self.view.size():
+                end = line_end.end()
+            cs_colors.erase(self.view, edit, end)
 
 class ClojureSublimedToggleOutputPanelCommand(sublime_plugin.WindowCommand):
     def run(self):
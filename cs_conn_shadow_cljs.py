@@ -1,5 +1,5 @@
 import os, re, sublime, sublime_plugin
-from . import cs_common, cs_conn, cs_conn_nrepl_raw, cs_eval
+from . import cs_bencode, cs_common, cs_conn, cs_conn_nrepl_raw, cs_eval
 
 class ConnectionShadowCljs(cs_conn_nrepl_raw.ConnectionNreplRaw):
     """
@@ -37,7 +37,8 @@ class ConnectionShadowCljs(cs_conn_nrepl_raw.ConnectionNreplRaw):
             if eval and eval.status == 'exception' and ('nil' == value or value.startswith(':repl/')):
                 pass
             else:
-                cs_eval.on_success(id, msg.get('value'))
+                truncated = isinstance(value, cs_bencode.Truncated)
+                cs_eval.on_success(id, value, truncated = truncated)
             return True
 
     def handle_err(self, msg):
@@ -63,7 +64,7 @@ class ConnectionShadowCljs(cs_conn_nrepl_raw.ConnectionNreplRaw):
 
     def load_file(self, view):
         if view.file_name():
-            super().load_file(view)
+            cs_conn.Connection.load_file(self, view)
         else:
             self.eval(view, [sublime.Region(0, view.size())])
 
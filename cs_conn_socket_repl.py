@@ -1,19 +1,171 @@
-import json, os, re, sublime, sublime_plugin, threading
-from . import cs_common, cs_conn, cs_eval, cs_eval_status, cs_parser, cs_warn, cs_watch
-
-def lines(socket):
-    buffer = b''
-    while True:
-        more = socket.recv(4096)
-        if more:
-            buffer += more
-        while b'\n' in buffer:
-            (line, buffer) = buffer.split(b'\n', 1)
-            yield line.decode()
-        if not more:
-            break
-    if buffer:
-        yield buffer.decode()
+import codecs, json, os, re, sublime, sublime_plugin
+from . import cs_common, cs_conn, cs_eval, cs_eval_status, cs_loop, cs_parser, cs_warn, cs_watch
+
+class Lines:
+    """
+    Splits incoming bytes into lines. Keeps unfinished line in a bytearray,
+    never rescans bytes it has already looked at.
+    Lines longer than `max_line` bytes are dropped and reported to `on_oversized(head, size)`,
+    head being first `max_line` bytes of the line. `on_overflow(head)` is called
+    as soon as line goes over `max_line`, before the rest of it arrives
+    """
+    def __init__(self, max_line = None, on_oversized = None, on_overflow = None):
+        self.buffer       = bytearray()
+        self.start        = 0 # where current line starts in buffer
+        self.scanned      = 0 # no '\n' in buffer[start:scanned]
+        self.max_line     = max_line
+        self.on_oversized = on_oversized
+        self.on_overflow  = on_overflow
+        self.head         = None # first bytes of oversized line being dropped
+        self.dropped      = 0
+
+    def feed(self, more):
+        """
+        Returns list of lines completed by `more`
+        """
+        res = []
+        buffer = self.buffer
+        buffer += more
+        while (end := buffer.find(b'\n', self.scanned)) >= 0:
+            if self.head is None and self.max_line and end - self.start > self.max_line:
+                self.overflow(buffer)
+            if self.head is not None:
+                self.oversized(end - self.start)
+            else:
+                res.append(buffer[self.start:end].decode())
+            self.start = self.scanned = end + 1
+        self.scanned = len(buffer)
+        if self.max_line and len(buffer) - self.start > self.max_line:
+            if self.head is None:
+                self.overflow(buffer)
+            self.dropped += len(buffer) - self.start
+            self.start = self.scanned = len(buffer)
+        if self.start >= len(buffer):
+            buffer.clear()
+            self.start = self.scanned = 0
+        elif self.start > 65536 and self.start > len(buffer) // 2:
+            del buffer[:self.start]
+            self.scanned -= self.start
+            self.start = 0
+        return res
+
+    def overflow(self, buffer):
+        self.head = bytes(buffer[self.start:self.start + self.max_line])
+        if self.on_overflow:
+            self.on_overflow(self.head)
+
+    def oversized(self, size):
+        head, self.head = self.head, None
+        size, self.dropped = self.dropped + size, 0
+        if self.on_oversized:
+            self.on_oversized(head, size)
+
+    def close(self):
+        """
+        Returns unterminated last line, if any
+        """
+        if self.head is not None:
+            self.oversized(len(self.buffer) - self.start)
+            return []
+        return [self.buffer[self.start:].decode()] if self.start < len(self.buffer) else []
+
+class Frames:
+    """
+    Reader for opt-in framing (see framed-out-fn in socket_repl.clj). Each message
+    is EDN header line followed by raw string fields, header["payload"] lists
+    their names and lengths in code points. Until server reports it has started,
+    input is returned as plain text lines.
+    Fields longer than `max_field` are cut, their names are listed in msg["truncated"].
+    The rest of such field is skipped as it arrives, never accumulated.
+    `on_overflow(header)` is called when header announces such a field
+    """
+    def __init__(self, max_field = 0, on_overflow = None):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.chunks  = [] # decoded text, not joined until needed
+        self.size    = 0  # total length of chunks
+        self.pos     = 0  # consumed part of chunks
+        self.scanned = 0  # no '\n' in text[pos:scanned]
+        self.framed  = False
+        self.header  = None # header waiting for its payload
+        self.fields  = None # [(name, length)]
+        self.field   = 0    # index of field being read
+        self.got     = 0    # consumed length of that field
+        self.parts   = []   # kept pieces of that field
+        self.max_field = max_field
+        self.on_overflow = on_overflow
+
+    def text(self):
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0] if self.chunks else ''
+
+    def read_fields(self):
+        """
+        Consumes as much payload as there is. Returns True when all fields are read
+        """
+        text = self.text()
+        msg = self.header
+        while self.field < len(self.fields):
+            name, length = self.fields[self.field]
+            keep = min(length, self.max_field or length)
+            take = min(length - self.got, self.size - self.pos)
+            if self.got < keep:
+                self.parts.append(text[self.pos:self.pos + min(take, keep - self.got)])
+            self.pos += take
+            self.got += take
+            if self.got < length:
+                return False
+            # Slicing is the only per-message work on payload: no unescaping
+            msg[name] = ''.join(self.parts)
+            if keep < length:
+                msg.setdefault('truncated', []).append(name)
+            self.field += 1
+            self.got = 0
+            self.parts = []
+        return True
+
+    def feed(self, more):
+        """
+        Returns list of plain text lines (str) and messages (dict) completed by `more`
+        """
+        if text := self.decoder.decode(more):
+            self.chunks.append(text)
+            self.size += len(text)
+        res = []
+        while True:
+            if self.header is None:
+                text = self.text()
+                end = text.find('\n', self.scanned)
+                if end < 0:
+                    self.scanned = self.size
+                    break
+                line = text[self.pos:end]
+                self.pos = self.scanned = end + 1
+                if not self.framed:
+                    self.framed = '{"tag" "started"}' in line
+                    res.append(line)
+                    continue
+                header = cs_parser.read_message(line)
+                words = header.pop('payload', '').split()
+                self.fields = [(name, int(length)) for name, length in zip(words[::2], words[1::2])]
+                self.field = 0
+                self.header = header
+                if self.on_overflow and self.max_field and any(length > self.max_field for _, length in self.fields):
+                    self.on_overflow(header)
+            if not self.read_fields():
+                break
+            res.append(self.header)
+            self.header = None
+            self.scanned = self.pos
+        if self.pos >= self.size:
+            self.chunks, self.size, self.pos, self.scanned = [], 0, 0, 0
+        elif self.pos > 65536 and self.header is None:
+            text = self.text()[self.pos:]
+            self.chunks, self.size, self.scanned, self.pos = [text], len(text), self.scanned - self.pos, 0
+        return res
+
+    def close(self):
+        return []
 
 def escape(s):
     return s.replace('\\', '\\\\').replace('"', '\\"')
@@ -25,47 +177,98 @@ class ConnectionSocketRepl(cs_conn.Connection):
     def __init__(self, addr):
         super().__init__()
         self.addr      = addr
-        self.socket    = None
-        self.reader    = None
+        self.channel   = None
+        self.lines     = None
+        self.started   = False
         self.closing   = False
 
     def connect_impl(self):
         self.set_status(0, 'Connecting to {}', self.get_addr())
-        self.socket = cs_common.socket_connect(self.get_addr())
-        self.reader = threading.Thread(daemon=True, target=self.read_loop)
-        self.reader.start()
+        socket = cs_common.socket_connect(self.get_addr())
+        framing = cs_common.setting('socket_repl_framing', 'text')
+        budget = cs_common.setting('value_budget', 1000000)
+        if framing == 'length':
+            self.lines = Frames(max_field = budget, on_overflow = self.handle_overflow)
+        else:
+            self.lines = Lines(max_line = cs_common.setting('socket_repl_max_line', 0) or budget,
+                               on_oversized = self.handle_oversized,
+                               on_overflow = self.handle_overflow)
+        self.channel = cs_loop.register(socket, self.on_data, self.on_close)
+        self.set_status(1, 'Upgrading REPL')
+        self.send(cs_common.clojure_source('core.clj'))
+        self.send(cs_common.clojure_source('socket_repl.clj'))
+        if shared := cs_common.setting('eval_shared'):
+            self.send(shared)
+        if framing == 'length':
+            self.send('(repl {"framing" "length"})\n')
+        else:
+            self.send("(repl)\n")
 
     def disconnect_impl(self):
         cs_watch.erase_watches(lambda w: w.view.window() == self.window)
-        if self.socket:
-            self.socket.close()
-            self.socket = None
-
-    def read_loop(self):
-        try:
-            self.set_status(1, 'Upgrading REPL')
-            self.send(cs_common.clojure_source('core.clj'))
-            self.send(cs_common.clojure_source('socket_repl.clj'))
-            if shared := cs_common.setting('eval_shared'):
-                self.send(shared)
-            self.send("(repl)\n")
-            started = False
-            for line in lines(self.socket):
+        if self.channel:
+            self.channel.close()
+            self.channel = None
+
+    def on_data(self, data):
+        """
+        Called on event loop thread
+        """
+        for line in self.lines.feed(data):
+            if isinstance(line, dict):
                 cs_common.debug('RCV {}', line)
-                if started:
-                    msg = cs_parser.parse_as_dict(line)
-                    self.handle_msg(msg)
-                else:
-                    if '{"tag" "started"}' in line:
-                        self.set_status(4, self.get_addr())
-                        started = True
-        except OSError:
-            pass
+                self.handle_msg(line)
+            else:
+                self.handle_line(line)
+
+    def on_close(self):
+        for line in self.lines.close():
+            self.handle_line(line)
+        self.channel = None
         self.disconnect()
 
+    def handle_line(self, line):
+        cs_common.debug('RCV {}', line)
+        if self.started:
+            msg = cs_parser.read_message(line)
+            self.handle_msg(msg)
+        elif '{"tag" "started"}' in line:
+            self.set_status(4, self.get_addr())
+            self.started = True
+
+    def handle_overflow(self, head):
+        """
+        Called on event loop thread when a message goes over value_budget
+        or socket_repl_max_line: stop the eval producing it
+        """
+        if isinstance(head, dict):
+            id = head.get('id')
+        elif id := re.search(r'"id" (\d+)', head.decode(errors = 'ignore')):
+            id = id.group(1)
+        if id is not None:
+            self.send(f'{{"id" {id}, "op" "interrupt"}}')
+
+    def handle_oversized(self, head, size):
+        """
+        Keys are sorted, so "val" comes last and head has everything else
+        plus beginning of the value
+        """
+        head = head.decode(errors = 'ignore')
+        message = f'Message of {size} bytes is larger than socket_repl_max_line, dropped'
+        id  = re.search(r'"id" (\d+)', head)
+        idx = re.search(r'"idx" (\d+)', head)
+        if id and idx and re.search(r'"tag" "ret"', head) and (val := re.search(r'"val" "((?:[^"\\]|\\u[0-9a-fA-F]{4}|\\[^u])*)', head)):
+            # val is cut at the last complete escape sequence
+            value = cs_parser.read_message('{"val" "' + val.group(1) + '"}')['val']
+            cs_eval.on_success(f'{id.group(1)}.{idx.group(1)}', value, truncated = True)
+        elif id and idx and re.search(r'"tag" "(ret|ex)"', head):
+            cs_eval.on_exception(f'{id.group(1)}.{idx.group(1)}', message)
+        else:
+            cs_common.warn('{}: {}', message, head[:100])
+
     def send(self, msg):
         cs_common.debug('SND {}', msg)
-        self.socket.sendall(msg.encode())
+        self.channel.send(msg.encode())
 
     def eval_impl(self, form):
         msg = f'{{' + \
@@ -120,6 +323,34 @@ class ConnectionSocketRepl(cs_conn.Connection):
             )
             self.eval_impl(form)
 
+    def eval_forms(self, view, regions, on_finish = None):
+        """
+        Sends all forms as one batch, so they are evaluated in order. Text between
+        forms is blanked out to keep line and column numbers
+        """
+        cs_warn.reset_warnings(self.window)
+        transform_fn = cs_watch.transform(view)
+        batch_id = cs_eval.Eval.next_id()
+        start = regions[0].begin()
+        pos = start
+        code = ''
+        for idx, region in enumerate(regions):
+            code += re.sub(r'[^\r\n]', ' ', view.substr(sublime.Region(pos, region.begin())))
+            code += transform_fn(view.substr(region), eval_region = region)
+            pos = region.end()
+            cs_eval.Eval(view, region, id = f'{batch_id}.{idx}', batch_id = batch_id, on_finish = on_finish)
+        (line, column) = view.rowcol_utf16(start)
+        form = cs_common.Form(
+            id   = batch_id,
+            code = code,
+            ns   = cs_parser.namespace(view, start) or 'user',
+            line = line + 1,
+            column = column,
+            file = view.file_name(),
+            print_quota = cs_common.setting('print_quota')
+        )
+        self.eval_impl(form)
+
     def eval_status(self, code, ns):
         cs_warn.reset_warnings(self.window)
         batch_id = cs_eval.Eval.next_id()
@@ -144,7 +375,7 @@ class ConnectionSocketRepl(cs_conn.Connection):
             idx  = msg.get('idx')
             val  = msg.get('val')
             time = msg.get('time')
-            cs_eval.on_success(f'{id}.{idx}', val, time = time)
+            cs_eval.on_success(f'{id}.{idx}', val, time = time, truncated = 'val' in msg.get('truncated', []))
             return True
 
     def handle_watch(self, msg):
@@ -176,7 +407,7 @@ class ConnectionSocketRepl(cs_conn.Connection):
     def handle_lookup(self, msg):
         if 'lookup' == msg['tag']:
             id = msg.get('id')
-            val = cs_parser.parse_as_dict(msg['val'])
+            val = cs_parser.read_message(msg['val'])
             cs_eval.on_lookup(id, val)
             return True
 
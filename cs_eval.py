@@ -2,8 +2,12 @@ import collections, html, os, re, sublime, sublime_plugin
 from typing import Any, Dict, Tuple
 from . import cs_common, cs_conn, cs_eval_status, cs_parser, cs_printer, cs_progress, cs_watch
 
+annotation_max = 1000 # characters of value shown inline, full value is in phantom and copy
+
 evals = {} # Dict[int, Eval]
 evals_by_view = collections.defaultdict(dict) # Dict[int, Dict[int, Eval]]
+regions_by_view = collections.defaultdict(cs_common.RegionIndex) # Dict[int, RegionIndex]
+evaluated_by_view = collections.defaultdict(dict) # Dict[int, Dict[tuple | int, int]], form key -> hash of last successfully evaluated text
 
 class Eval:
     """
@@ -23,6 +27,8 @@ class Eval:
     session:      str
     trace:        str
     phantom_id:   int
+    phantom_texts: Dict[Tuple[str, int], Tuple[str, cs_common.PhantomText]] # (kind, wrap width) -> (source, text)
+    truncated:    bool # value was cut by client to value_budget
 
     def next_id():
         Eval.last_id += 1
@@ -30,7 +36,9 @@ class Eval:
     
     def __init__(self, view, region, id = None, batch_id = None, on_finish = None):
         line = view.line(region)
-        erase_evals(lambda eval: eval.region() and eval.region().intersects(line), view)
+        for eval, eval_region in regions_by_view[view.id()].find(line):
+            if eval_region and eval_region.intersects(line):
+                eval.erase()
         
         id = id or Eval.next_id()
         self.id = id
@@ -44,12 +52,16 @@ class Eval:
         self.ex_column = None
         self.trace = None
         self.phantom_id = None
+        self.phantom_texts = {}
         self.value = None
+        self.truncated = False
         self.on_finish = on_finish
         
         evals[id] = self
         evals_by_view[view.id()][id] = self
 
+        self.status = None
+        regions_by_view[view.id()].add(self, region)
         self.update("pending", cs_progress.phase(), region)
         cs_progress.wake()        
 
@@ -62,61 +74,86 @@ class Eval:
             return regions[0]
 
     def update(self, status, value, region = None, time_taken = None):
+        was_pending = self.status == "pending"
         self.status = status
         self.value = value
         region = region or self.region()
         if region:
             scope, color = cs_common.scope_color(self.view, self.status)
-            if value:
+            if status == "pending":
+                # spinner annotation is drawn by cs_progress, for all pending evals at once
+                self.view.add_regions(self.region_key(), [region], scope, '', sublime.DRAW_NO_FILL + sublime.NO_UNDO)
+            elif value:
+                if len(value) > annotation_max:
+                    value = value[:annotation_max] + '…'
+                if self.truncated:
+                    value += ' (truncated)'
                 if (self.status in {"success", "failure", "exception"}) and (time := cs_common.format_time_taken(time_taken)):
                     value = time + " " + value
                 self.view.add_regions(self.region_key(), [region], scope, '', sublime.DRAW_NO_FILL + sublime.NO_UNDO, [cs_common.escape(value)], color)
             else:
                 self.view.erase_regions(self.region_key())
                 self.view.add_regions(self.region_key(), [region], scope, '', sublime.DRAW_NO_FILL + sublime.NO_UNDO)
+        if was_pending and status != "pending":
+            cs_progress.refresh(self.view)
 
-    def toggle_phantom(self, text, styles):
-        if text:
+    def phantom_text(self, kind, source, format_fn):
+        """
+        PhantomText of source formatted by format_fn(limit), cached
+        per kind and wrap width for as long as source stays the same
+        """
+        limit = cs_common.wrap_width(self.view)
+        key = (kind, limit)
+        cached = self.phantom_texts.get(key)
+        if not cached or cached[0] is not source:
+            wrap_fn = lambda line: cs_printer.wrap_string(line, limit = limit)
+            cached = (source, cs_common.PhantomText(format_fn(limit) if source else None, wrap_fn))
+            self.phantom_texts[key] = cached
+        return cached[1]
+
+    def show_phantom(self, text, styles, count = None):
+        if region := self.region():
             if self.phantom_id:
                 self.view.erase_phantom_by_id(self.phantom_id)
-                self.phantom_id = None
-            else:
-                body = f"""<body id='clojure-sublimed'>
-                    { cs_common.basic_styles(self.view) }
-                    { styles }
-                </style>"""
-                limit = cs_common.wrap_width(self.view)
-                for line in text.splitlines():
-                    line = cs_printer.wrap_string(line, limit = limit)
-                    line = cs_common.escape(line)
-                    body += "<p>" + line + "</p>"
-                body += "</body>"
-                region = self.region()
-                if region:
-                    point = self.view.line(region.end()).begin()
-                    self.phantom_id = self.view.add_phantom(self.region_key(), sublime.Region(point, point), body, sublime.LAYOUT_BLOCK)
+            point = self.view.line(region.end()).begin()
+            on_more = lambda count: self.show_phantom(text, styles, count)
+            self.phantom_id = cs_common.add_text_phantom(self.view, self.region_key(), point, styles, text, count, on_more)
+
+    def toggle_phantom(self, text, styles):
+        if self.phantom_id:
+            self.view.erase_phantom_by_id(self.phantom_id)
+            self.phantom_id = None
+        elif not text.is_empty():
+            self.show_phantom(text, styles)
+
+    def format_value(self, limit):
+        """
+        Large values are pretty-printed as a stream of lines, so that
+        phantom shows the head without formatting the whole value
+        """
+        value = self.value
+        if (stream_size := cs_common.setting('pprint_stream_size', 0)) and len(value) > stream_size:
+            chunks = (value[i:i + 4096] for i in range(0, len(value), 4096))
+            return cs_printer.format_lines(chunks, limit = limit)
+        return cs_printer.format_value(value, cs_parser.parse(value), limit = limit)
 
     def toggle_pprint(self):
-        node    = cs_parser.parse(self.value)
-        string  = cs_printer.format(self.value, node, limit = cs_common.wrap_width(self.view))
         styles  = """
             .light body { background-color: hsl(100, 100%, 90%); }
             .dark body  { background-color: hsl(100, 100%, 10%); }
         """ 
         if phantom_styles := cs_common.phantom_styles(self.view, "phantom_success"):
             styles += f".light body, .dark body {{ { phantom_styles }; border: 4px solid #33CC33; }}"
-        self.toggle_phantom(string, styles)
+        self.toggle_phantom(self.phantom_text('pprint', self.value, self.format_value), styles)
 
     def toggle_failure(self):
-        node    = cs_parser.parse(self.value)
-        string  = cs_printer.format(self.value, node, limit = cs_common.wrap_width(self.view))
         styles  = """
             .light body { background-color: hsl(0, 100%, 90%); }
             .dark body  { background-color: hsl(0, 100%, 10%); }
         """ 
         if phantom_styles := cs_common.phantom_styles(self.view, "phantom_failure"):
             styles += f".light body, .dark body {{ { phantom_styles }; border: 4px solid #CC3333; }}"
-        self.toggle_phantom(string, styles)
+        self.toggle_phantom(self.phantom_text('pprint', self.value, self.format_value), styles)
         
     def toggle_trace(self):
         styles = """
@@ -125,7 +162,7 @@ class Eval:
         """
         if phantom_styles := cs_common.phantom_styles(self.view, "phantom_exception"):
             styles += f".light body, .dark body {{ {phantom_styles}; border: 4px solid #CC3333; }}"
-        self.toggle_phantom(self.trace, styles)
+        self.toggle_phantom(self.phantom_text('trace', self.trace, lambda limit: self.trace), styles)
 
     def erase(self, interrupt = True):
         self.view.erase_regions(self.region_key())
@@ -134,6 +171,9 @@ class Eval:
 
         del evals[self.id]
         del evals_by_view[self.view.id()][self.id]
+        regions_by_view[self.view.id()].remove(self)
+        if self.status == "pending":
+            cs_progress.refresh(self.view)
         if interrupt and self.status == "pending" and self.session:
             state = cs_common.get_state()
             state.conn.send({"op": "interrupt", "interrupt-id": self.id, "session": self.session})
@@ -151,9 +191,8 @@ def by_region(view, region):
     """
     Find an eval touching region
     """
-    for eval in list(evals_by_view[view.id()].values()):
-        if cs_common.regions_touch(eval.region(), region):
-            return eval
+    for eval, _ in regions_by_view[view.id()].find(region):
+        return eval
 
 def by_status(view, status):
     """
@@ -176,11 +215,30 @@ def erase_evals(predicate = lambda x: True, view = None):
         if predicate(eval):
             eval.erase()
 
-def on_success(id, value, time = None):
+def remember_evaluated(eval):
+    """
+    Records top-level forms of successful eval, for ClojureSublimedEvalChangedCommand
+    """
+    evaluated = evaluated_by_view[eval.view.id()]
+    code = eval.code
+    for node in cs_parser.parse(code).children:
+        if node.name not in {'comment', 'discard'}:
+            key, h = cs_parser.form_hash(node, code)
+            evaluated[key] = h
+
+def forget_evaluated(window):
+    for view in window.views():
+        evaluated_by_view.pop(view.id(), None)
+
+def on_success(id, value, time = None, truncated = False):
     """
-    Callback to be called after conn.eval or conn.load_file
+    Callback to be called after conn.eval or conn.load_file.
+    truncated means connection only kept first value_budget bytes of value
     """
     if (eval := by_id(id)):
+        eval.truncated = truncated
+        if isinstance(eval, Eval):
+            remember_evaluated(eval)
         failure = re.search(r":fail\s+[1-9]\d*", value) \
                or re.search(r":error\s+[1-9]\d*", value)
         eval.update("failure" if failure else "success", value, time_taken = time)
@@ -330,6 +388,51 @@ class ClojureSublimedEvalBufferCommand(sublime_plugin.TextCommand):
     def is_enabled(self):
         return cs_conn.ready(self.view.window())
 
+def references(node, names):
+    """
+    Does node mention any of the names, unqualified or with any namespace
+    """
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node.name == 'token':
+            text = node.text
+            if text in names or text[text.find('/') + 1:] in names:
+                return True
+        elif node.children:
+            stack.extend(node.children)
+    return False
+
+class ClojureSublimedEvalChangedCommand(sublime_plugin.TextCommand):
+    """
+    Eval top-level forms whose text changed since their last successful eval.
+    With dependents = True, also forms that reference symbols defined by those
+    """
+    def run(self, edit, dependents = False):
+        view = self.view
+        evaluated = evaluated_by_view[view.id()]
+        names = set()
+        regions = []
+        skipped = 0
+        text = view.substr(sublime.Region(0, view.size()))
+        for node in cs_parser.parse_tree(view).children:
+            if node.name in {'comment', 'discard'}:
+                continue
+            key, h = cs_parser.form_hash(node, text)
+            if evaluated.get(key) != h or (names and references(node, names)):
+                regions.append(sublime.Region(node.start, node.end))
+                if dependents and (sym := cs_parser.defsym(node)):
+                    names.add(sym[sym.find('/') + 1:])
+            else:
+                skipped += 1
+        if regions:
+            state = cs_common.get_state(view.window())
+            state.conn.eval_forms(view, regions)
+        view.window().status_message(f'Evaluating {len(regions)} changed forms, {skipped} unchanged skipped')
+
+    def is_enabled(self):
+        return cs_conn.ready(self.view.window())
+
 class ClojureSublimedCopyCommand(sublime_plugin.TextCommand):
     """
     Copy .value of eval under cursor to clipboard
@@ -434,14 +537,26 @@ class ClojureSublimedInterruptEvalCommand(sublime_plugin.TextCommand):
 class EventListener(sublime_plugin.EventListener):
     def on_close(self, view):
         erase_evals(view = view)
+        evaluated_by_view.pop(view.id(), None)
+        regions_by_view.pop(view.id(), None)
 
 class TextChangeListener(sublime_plugin.TextChangeListener):
+    def on_text_changed(self, changes):
+        for view in self.buffer.views():
+            if view.id() in regions_by_view:
+                regions_by_view[view.id()].shift(view, cs_common.changes_deltas(changes))
+
     def on_text_changed_async(self, changes):
         view = self.buffer.primary_view()
-        changed = [sublime.Region(x.a.pt, x.b.pt) for x in changes]
-        def should_erase(eval):
-            return not (reg := eval.region()) or any(reg.intersects(r) for r in changed) and view.substr(reg) != eval.code
-        erase_evals(should_erase, view)
+        index = regions_by_view[view.id()]
+        to_erase = {}
+        for r in (sublime.Region(x.a.pt, x.b.pt) for x in changes):
+            for eval, reg in index.find(r):
+                if not reg or reg.intersects(r) and view.substr(reg) != eval.code:
+                    to_erase[eval.id] = eval
+        for eval in to_erase.values():
+            if eval.id in evals:
+                eval.erase()
 
 def plugin_unloaded():
     erase_evals()
@@ -79,12 +79,30 @@ def skip_spaces(view, point):
         point = point + 1
     return point
 
+def tree_with_trailing_space(view):
+    """
+    Same tree as parsing buffer text + ' ', so a form cut by the end of buffer
+    (e.g. trailing \\ in an unclosed string) is read as if followed by a space.
+    Parser looks at most one char past a form, so only forms ending
+    in the last two chars can differ from the cached parse_tree
+    """
+    parsed = cs_parser.parse_tree(view)
+    size = view.size()
+    keep = len(parsed.children)
+    while keep > 0 and parsed.children[keep - 1].end >= size - 1:
+        keep -= 1
+    if keep == len(parsed.children):
+        return parsed
+    text = view.substr(sublime.Region(0, size)) + ' '
+    start = parsed.children[keep].start
+    return cs_parser.Node(0, len(text), parsed.children[:keep] + list(cs_parser.parse_items(text, start)), name = 'source')
+
 def indent_lines(view, selections, edit):
     """
     Given set of sorted ranges (`selections`), indents all lines touched by those selections
     """
     # Calculate all replacements first
-    parsed = cs_parser.parse(view.substr(sublime.Region(0, view.size())) + ' ')
+    parsed = tree_with_trailing_space(view)
     replacements = {} # row -> (begin, delta_i)
     for sel in selections:
         for line in view.lines(sel):
@@ -0,0 +1,195 @@
+import collections, selectors, socket, threading
+from . import cs_common
+
+min_recv_size = 64 * 1024
+max_recv_size = 4 * 1024 * 1024
+
+class Channel:
+    """
+    Socket owned by event loop. Received bytes are passed to on_data(bytes)
+    on loop thread, on_close() is called once, after socket is closed by either side
+    """
+    def __init__(self, socket, on_data, on_close):
+        self.socket    = socket
+        self.on_data   = on_data
+        self.on_close  = on_close
+        self.queue     = collections.deque() # bytes/memoryviews waiting to be sent
+        self.recv_size = min_recv_size
+        self.events    = 0 # currently registered in selector
+        self.closing   = False
+        self.closed    = False
+
+    def send(self, data):
+        """
+        Queues data to be sent, never blocks. Safe to call from any thread
+        """
+        if data and not self.closing:
+            self.queue.append(data)
+            loop.update(self)
+
+    def close(self):
+        """
+        Closes socket after everything queued so far has been sent
+        """
+        if not self.closing:
+            self.closing = True
+            loop.update(self)
+
+class Loop:
+    """
+    Single thread that does I/O for all REPL connections in all windows.
+    Started on first connection, sleeps in select() when nothing happens
+    """
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.thread   = None
+        self.selector = None
+        self.waker    = None # (read end, write end) of socketpair that interrupts select()
+        self.pending  = [] # channels that need selector update, guarded by lock
+
+    def start(self):
+        if not self.thread:
+            self.selector = selectors.DefaultSelector()
+            self.waker = socket.socketpair()
+            for s in self.waker:
+                s.setblocking(False)
+            self.selector.register(self.waker[0], selectors.EVENT_READ)
+            self.thread = threading.Thread(daemon = True, target = self.run_loop)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread:
+            self.wake()
+            thread.join(1)
+
+    def wake(self):
+        try:
+            self.waker[1].send(b'\0')
+        except OSError: # buffer full means loop will wake up anyway
+            pass
+
+    def register(self, socket, on_data, on_close):
+        """
+        Takes ownership of connected socket. Returns Channel
+        """
+        socket.setblocking(False)
+        channel = Channel(socket, on_data, on_close)
+        with self.lock:
+            self.start()
+        self.update(channel)
+        return channel
+
+    def update(self, channel):
+        with self.lock:
+            self.pending.append(channel)
+        self.wake()
+
+    def run_loop(self):
+        thread = threading.current_thread()
+        while self.thread is thread:
+            for key, mask in self.selector.select():
+                if key.fileobj is self.waker[0]:
+                    try:
+                        while self.waker[0].recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                channel = key.data
+                if mask & selectors.EVENT_WRITE:
+                    self.write(channel)
+                if mask & selectors.EVENT_READ and not channel.closed:
+                    self.read(channel)
+            with self.lock:
+                pending, self.pending = self.pending, []
+            for channel in pending:
+                self.refresh(channel)
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, Channel):
+                self.close(key.data)
+        self.selector.close()
+        for s in self.waker:
+            s.close()
+
+    def refresh(self, channel):
+        """
+        Syncs selector with what channel needs now
+        """
+        if channel.closed:
+            return
+        if channel.closing and not channel.queue:
+            self.close(channel)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if channel.queue else 0)
+        if events != channel.events:
+            if channel.events:
+                self.selector.modify(channel.socket, events, channel)
+            else:
+                self.selector.register(channel.socket, events, channel)
+            channel.events = events
+
+    def write(self, channel):
+        queue = channel.queue
+        try:
+            while queue:
+                data = queue[0]
+                sent = channel.socket.send(data)
+                if sent < len(data):
+                    queue[0] = memoryview(data)[sent:]
+                    return
+                queue.popleft()
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close(channel)
+            return
+        self.refresh(channel)
+
+    def read(self, channel):
+        try:
+            data = channel.socket.recv(channel.recv_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.close(channel)
+            return
+        # grow buffer while socket keeps filling it, shrink back when traffic calms down
+        if len(data) == channel.recv_size and channel.recv_size < max_recv_size:
+            channel.recv_size *= 2
+        elif len(data) < channel.recv_size // 4 and channel.recv_size > min_recv_size:
+            channel.recv_size //= 2
+        try:
+            channel.on_data(data)
+        except Exception:
+            cs_common.error('Handling data from {}', channel.socket)
+
+    def close(self, channel):
+        if channel.closed:
+            return
+        channel.closed = True
+        channel.closing = True
+        if channel.events:
+            self.selector.unregister(channel.socket)
+            channel.events = 0
+        channel.queue.clear()
+        try:
+            channel.socket.close()
+        except OSError:
+            pass
+        try:
+            channel.on_close()
+        except Exception:
+            cs_common.error('Closing {}', channel.socket)
+
+loop = Loop()
+
+def register(socket, on_data, on_close):
+    return loop.register(socket, on_data, on_close)
+
+def plugin_unloaded():
+    loop.stop()
@@ -1,18 +1,30 @@
-import re, time
+import collections, re, time
 
 class Node:
     """
     AST Node.
     Start-end positions in string. Start included, end excluded.
     Optional children. Name from Named ('token', 'string' etc).
-    Text is substring[start:end], only for terminal nodes like Regex or String
+    Text is substring[start:end], only for terminal nodes like Regex or String.
+    Terminals keep a reference to the source string and slice text on demand
     """
-    def __init__(self, start, end, children = None, name = None, text = None):
+    __slots__ = ('start', 'end', 'children', 'name', 'source', '_text', '_fields')
+
+    def __init__(self, start, end, children = None, name = None, text = None, source = None):
         self.start = start
         self.end = end
         self.children = children if children is not None else []
         self.name = name
-        self.text = text
+        self.source = source
+        self._text = text
+        self._fields = None
+
+    @property
+    def text(self):
+        if self._text is not None:
+            return self._text
+        if self.source is not None:
+            return self.source[self.start:self.end]
 
     def __str__(self, indent = ""):
         res = "{}({} {}..{}".format(indent, self.name, self.start, self.end)
@@ -25,9 +37,15 @@ class Node:
         return res
 
     def __getattr__(self, name):
-        for child in self.children:
-            if child.name == "." + name:
-                return child
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if (fields := self._fields) is None:
+            fields = {}
+            for child in reversed(self.children):
+                if child.name and child.name[0] == '.':
+                    fields[child.name[1:]] = child
+            self._fields = fields
+        return fields.get(name)
 
     def restore_text(self, text):
         return text[self.start:self.end]
@@ -94,7 +112,7 @@ class Regex:
 
     def parse(self, string, pos):
         if match := self.pattern.match(string, pos):
-            return Node(pos, match.end(), name = self.name, text = match.group(0))
+            return Node(pos, match.end(), name = self.name, source = string)
 
 class String:
     """
@@ -108,7 +126,7 @@ class String:
     def parse(self, string, pos):
         if pos + self.len <= len(string):
             if string[pos:pos + self.len] == self.str:
-                return Node(pos, pos + self.len, name = self.name, text = self.str)
+                return Node(pos, pos + self.len, name = self.name, source = string)
 
 class Char:
     """
@@ -120,7 +138,7 @@ class Char:
 
     def parse(self, string, pos):
         if pos < len(string) and string[pos] == self.char:
-            return Node(pos, pos + 1, name = self.name, text = self.char)
+            return Node(pos, pos + 1, name = self.name, source = string)
 
 class NotChar:
     """
@@ -133,7 +151,7 @@ class NotChar:
     def parse(self, string, pos):
         if pos < len(string):
             if string[pos] != self.char:
-                return Node(pos, pos + 1, name = self.name, text = string[pos])
+                return Node(pos, pos + 1, name = self.name, source = string)
 
 class AnyChar:
     """
@@ -144,7 +162,7 @@ class AnyChar:
 
     def parse(self, string, pos):
         if pos < len(string):
-            return Node(pos, pos + 1, name = self.name, text = string[pos])
+            return Node(pos, pos + 1, name = self.name, source = string)
 
 class Seq:
     """
@@ -292,13 +310,372 @@ parsers['_form'] = Choice('token',
                           'tagged')
 
 # top-level parser
-parsers['source'] = Repeat(Choice('_gap', '_form', AnyChar(name = "error")), name = "source")
+parsers['_item'] = Choice('_gap', '_form', AnyChar(name = "error"))
+parsers['source'] = Repeat('_item', name = "source")
+
+# Scanner: alternative engine for the same grammar. Produces exactly the same
+# trees, but matches one master regex per step and keeps unfinished forms on
+# an explicit stack instead of going through combinators recursively
+
+scan_token = r'(?:##)?(?:\\[()\[\]{}\"@^;`, ]|' + token + ')'
+scan_gap = r'(?P<ws>[' + ws + r']+)|(?P<comment>;[^\n]*)|(?P<discard>#_)'
+scan_form = r'(?P<token>' + scan_token + ')' \
+            r'|(?P<string>#?")' \
+            r'|(?P<parens>(?:#\?@|#\?|#=|#)?\()' \
+            r'|(?P<brackets>\[)' \
+            r'|(?P<braces>(?:#(?::' + token + r')?)?\{)' \
+            r"|(?P<wrap>@|'|`|~@|~|#')" \
+            r'|(?P<meta>#?\^)' \
+            r'|(?P<tagged>#)'
+re_scan_item   = re.compile(scan_gap + '|' + scan_form)
+re_scan_gap    = re.compile(scan_gap)
+re_scan_form   = re.compile(scan_form)
+re_scan_token  = re.compile(scan_token)
+re_scan_marker = re.compile(r'#?\^')
+re_scan_string = re.compile(r'([^"\\]+|\\.)+')
+closers = {'parens': ')', 'brackets': ']', 'braces': '}'}
+
+# How parent expects frame result
+CTX_ITEM = 0 # any item, error on failure
+CTX_GAP  = 1 # gap, stop gaps on failure
+CTX_FORM = 2 # form, fail parent on failure
+
+# What unfinished prefix form is waiting for
+ST_GAPS_FORM   = 0 # gaps, then form
+ST_FORM        = 1 # form
+ST_GAPS_TAG    = 2 # gaps, then token
+ST_TAG         = 3 # token
+ST_GAPS_MARKER = 4 # gaps, then either next ^ or form
+
+class Frame:
+    """
+    Unfinished node on scanner stack
+    """
+    __slots__ = ('name', 'start', 'children', 'ctx', 'state', 'field', 'closer', 'body_start', 'body')
+
+    def __init__(self, name, start, children, ctx, state = None, field = None):
+        self.name = name
+        self.start = start
+        self.children = children
+        self.ctx = ctx
+        self.state = state
+        self.field = field
+        self.closer = None
+
+def scan_string(string, pos, end):
+    """
+    Terminal string node, starting with #?" matched at pos..end
+    """
+    children = [Node(pos, end, name = '.open', source = string)]
+    if match := re_scan_string.match(string, end):
+        children.append(Node(end, match.end(), name = '.body', source = string))
+        end = match.end()
+    if end < len(string) and string[end] == '"':
+        children.append(Node(end, end + 1, name = '.close', source = string))
+        end += 1
+    return Node(pos, end, children, name = 'string')
+
+def scan_frame(match, pos, ctx):
+    """
+    Frame for form that starts with match at pos
+    """
+    name = match.lastgroup
+    end = match.end()
+    string = match.string
+    if name == 'discard':
+        return Frame(name, pos, [Node(pos, end, name = 'marker', source = string)], ctx, ST_GAPS_FORM, '.body')
+    elif name == 'wrap':
+        return Frame(name, pos, [Node(pos, end, name = '.marker', source = string)], ctx, ST_GAPS_FORM, '.body')
+    elif name == 'meta':
+        return Frame(name, pos, [Node(pos, end, name = '.marker', source = string)], ctx, ST_GAPS_FORM, '.meta')
+    elif name == 'tagged':
+        return Frame(name, pos, [], ctx, ST_GAPS_TAG)
+    else:
+        frame = Frame(name, pos, [Node(pos, end, name = '.open', source = string)], ctx)
+        frame.closer = closers[name]
+        frame.body_start = end
+        frame.body = []
+        return frame
+
+def scan(string, pos = 0):
+    """
+    Generator of top-level nodes of `string`, starting from `pos`.
+    Same as parse_items, but with scanner engine
+    """
+    length = len(string)
+    stack = []
+    match_item = re_scan_item.match
+    match_gap = re_scan_gap.match
+    match_form = re_scan_form.match
+    while True:
+        node = None
+        ctx = CTX_ITEM
+
+        # top level or inside (), [], {}
+        if not stack or stack[-1].closer:
+            frame = stack[-1] if stack else None
+            if pos >= length or (frame and string[pos] == frame.closer):
+                if not frame:
+                    return
+                # finish (), [], {}
+                children = frame.children
+                if pos > frame.body_start:
+                    children.append(Node(frame.body_start, pos, frame.body, name = '.body'))
+                if pos < length:
+                    children.append(Node(pos, pos + 1, name = '.close', source = string))
+                    pos += 1
+                stack.pop()
+                node = Node(frame.start, pos, children, name = frame.name)
+                ctx = frame.ctx
+            elif match := match_item(string, pos):
+                name = match.lastgroup
+                end = match.end()
+                if name == 'ws':
+                    pos = end
+                    continue
+                elif name == 'token' or name == 'comment':
+                    node = Node(pos, end, name = name, source = string)
+                    pos = end
+                elif name == 'string':
+                    node = scan_string(string, pos, end)
+                    pos = node.end
+                else:
+                    stack.append(scan_frame(match, pos, CTX_ITEM))
+                    pos = end
+                    continue
+            else:
+                node = Node(pos, pos + 1, name = 'error', source = string)
+                pos += 1
+
+        # inside #_, ', ^, #tag
+        else:
+            frame = stack[-1]
+            state = frame.state
+            failed = False
+            if state == ST_GAPS_FORM or state == ST_GAPS_TAG or state == ST_GAPS_MARKER:
+                if match := match_gap(string, pos):
+                    name = match.lastgroup
+                    if name == 'ws':
+                        pos = match.end()
+                    elif name == 'comment':
+                        frame.children.append(Node(pos, match.end(), name = name, source = string))
+                        pos = match.end()
+                    else:
+                        stack.append(scan_frame(match, pos, CTX_GAP))
+                        pos = match.end()
+                elif state == ST_GAPS_FORM:
+                    frame.state = ST_FORM
+                elif state == ST_GAPS_TAG:
+                    frame.state = ST_TAG
+                elif match := re_scan_marker.match(string, pos):
+                    frame.children.append(Node(pos, match.end(), name = '.marker', source = string))
+                    frame.state = ST_GAPS_FORM
+                    frame.field = '.meta'
+                    pos = match.end()
+                else:
+                    frame.state = ST_FORM
+                    frame.field = '.body'
+                continue
+            elif state == ST_TAG:
+                if match := re_scan_token.match(string, pos):
+                    frame.children.append(Node(pos, match.end(), [Node(pos, match.end(), name = 'token', source = string)], name = '.tag'))
+                    frame.state = ST_GAPS_FORM
+                    frame.field = '.body'
+                    pos = match.end()
+                    continue
+                failed = True
+            elif match := match_form(string, pos):
+                name = match.lastgroup
+                end = match.end()
+                if name == 'token':
+                    node = Node(pos, end, name = name, source = string)
+                    pos = end
+                    ctx = CTX_FORM
+                elif name == 'string':
+                    node = scan_string(string, pos, end)
+                    pos = node.end
+                    ctx = CTX_FORM
+                else:
+                    stack.append(scan_frame(match, pos, CTX_FORM))
+                    pos = end
+                    continue
+            else:
+                failed = True
+
+            # Failed frame is dropped, then its parent tries alternatives
+            # at the same position, same way combinators backtrack
+            while failed:
+                frame = stack.pop()
+                pos = frame.start
+                failed = False
+                if frame.ctx == CTX_GAP:
+                    # #_ can't be ^, so meta goes straight to body
+                    parent = stack[-1]
+                    if parent.state == ST_GAPS_TAG:
+                        parent.state = ST_TAG
+                    else:
+                        if parent.state == ST_GAPS_MARKER:
+                            parent.field = '.body'
+                        parent.state = ST_FORM
+                elif frame.name != 'tagged' and string[pos] == '#':
+                    stack.append(Frame('tagged', pos, [], frame.ctx, ST_GAPS_TAG))
+                    pos += 1
+                elif frame.ctx == CTX_ITEM:
+                    node = Node(pos, pos + 1, name = 'error', source = string)
+                    pos += 1
+                else:
+                    failed = True
+            if node is None:
+                continue
+
+        # pass finished node up the stack
+        while node:
+            if not stack:
+                yield node
+                break
+            parent = stack[-1]
+            if ctx != CTX_FORM:
+                if parent.closer:
+                    parent.body.append(node)
+                else:
+                    parent.children.append(node)
+                break
+            parent.children.append(Node(node.start, node.end, [node], name = parent.field))
+            if parent.name == 'meta' and parent.field == '.meta':
+                parent.state = ST_GAPS_MARKER
+                break
+            stack.pop()
+            node = Node(parent.start, node.end, parent.children, name = parent.name)
+            ctx = parent.ctx
+
+# 'scanner' or 'combinators'
+engine = 'combinators'
 
 def parse(string):
     """
     The main function that parses string and returns AST
     """
-    return get_parser('source').parse(string, 0)
+    if engine == 'combinators':
+        try:
+            return get_parser('source').parse(string, 0)
+        except RecursionError:
+            # combinators recurse several frames per nesting level,
+            # scanner handles any depth
+            pass
+    return Node(0, len(string), list(scan(string)), name = "source" if string else None)
+
+def parse_items(string, pos = 0):
+    """
+    Generator of top-level nodes of `string`, starting from `pos`.
+    `pos` must be a boundary between two top-level forms
+    """
+    if engine != 'combinators':
+        yield from scan(string, pos)
+        return
+    parser = get_parser('_item')
+    while True:
+        try:
+            node = parser.parse(string, pos)
+        except RecursionError:
+            yield from scan(string, pos)
+            return
+        if not node:
+            return
+        children = []
+        append_children(children, node)
+        yield from children
+        pos = node.end
+
+def shift(node, delta, source = None):
+    """
+    Moves node and all its descendants by delta, in place.
+    Terminals are re-pointed to `source`, which must have the same text at the new positions.
+    Without `source`, terminals keep a copy of their text
+    """
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node.source is not None:
+            if source is None:
+                node._text = node.source[node.start:node.end]
+            node.source = source
+        node.start += delta
+        node.end += delta
+        stack.extend(node.children)
+
+def reparse(parsed, old, new, start, old_end, new_end):
+    """
+    Given `parsed` = parse(old) and the fact that old[start:old_end] was
+    replaced with new[start:new_end], returns parse(new), reusing top-level
+    forms that are not affected by the change. Modifies `parsed` in place.
+    """
+    children = parsed.children
+
+    # Top-level forms before the change can be kept as-is. Parsers might look
+    # up to two chars past node end (`"\` in string). Errors are leftovers of
+    # failed attempts (`#tag` or `^meta` without value) that might have looked
+    # arbitrary far ahead, so we re-parse starting from them (closing parens
+    # are safe)
+    keep = 0
+    for child in children:
+        if child.end >= start - 1 or (child.name == 'error' and child.text not in ')]}'):
+            break
+        keep += 1
+    pos = children[keep - 1].end if keep > 0 else 0
+
+    # Parse until we reach the position after the change that was also
+    # a boundary between top-level forms in the old tree. Text after that
+    # is the same, so the rest of the old tree can be reused
+    delta = new_end - old_end
+    res = children[:keep]
+    idx = keep
+    for node in parse_items(new, pos):
+        res.append(node)
+        if node.end < new_end:
+            continue
+        old_pos = node.end - delta
+        while idx < len(children) and children[idx].end < old_pos:
+            idx += 1
+        if idx < len(children):
+            if children[idx].end == old_pos:
+                idx += 1
+            elif children[idx].start != old_pos:
+                continue
+            for child in children[idx:]:
+                shift(child, delta, new)
+                res.append(child)
+            break
+    return Node(0, len(new), res, name = "source" if new else None)
+
+def edit_range(old, new, hint = None):
+    """
+    Returns (start, old_end, new_end) such that only old[start:old_end] and
+    new[start:new_end] differ. `hint` is a guess in the same format, used
+    if it is correct, otherwise common prefix and suffix are computed
+    """
+    if hint:
+        start, old_end, new_end = hint
+        if 0 <= start <= old_end <= len(old) \
+           and len(old) - old_end == len(new) - new_end \
+           and old[:start] == new[:start] \
+           and old[old_end:] == new[new_end:]:
+            return hint
+    length = min(len(old), len(new))
+    chunk = 4096
+    start = 0
+    while start + chunk <= length and old[start:start + chunk] == new[start:start + chunk]:
+        start += chunk
+    while start < length and old[start] == new[start]:
+        start += 1
+    old_end = len(old)
+    new_end = len(new)
+    while old_end - chunk >= start and new_end - chunk >= start and old[old_end - chunk:old_end] == new[new_end - chunk:new_end]:
+        old_end -= chunk
+        new_end -= chunk
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+    return (start, old_end, new_end)
 
 def is_symbol(node):
     """
@@ -364,7 +741,7 @@ def as_obj(node, string):
 def parse_as_dict(string):
     parsed = parse(string)
     braces = parsed.children[0]
-    assert 'braces' == braces
+    assert 'braces' == braces.name
     dict = {}
     for key, val in partition(braces.body.children, 2):
         key = as_obj(key, string)
@@ -372,6 +749,42 @@ def parse_as_dict(string):
         dict[key] = val
     return dict
 
+re_message_pair = re.compile(r'[\s,]*"([^"\\]*(?:\\.[^"\\]*)*)"[\s,]+' # key
+                             r'(?:"([^"\\]*(?:\\.[^"\\]*)*)"' # string
+                             r'|([+-]?[0-9]+)(?![^\s,}])' # int
+                             r'|(nil|true|false)(?![^\s,}])'
+                             r'|(:[^' + r'()\[\]{}\"@^;`' + ws + r']+))') # keyword
+re_message_end = re.compile(r'[\s,]*\}\s*')
+re_escape = re.compile(r'\\[\\"rntfb]')
+constants = {'nil': None, 'true': True, 'false': False}
+
+def read_message(string):
+    """
+    Fast path for parse_as_dict: reads flat map with string keys and
+    string, int, nil/true/false or keyword values (what Socket REPL server sends)
+    straight to dict, without building AST. Falls back to parse_as_dict for anything else
+    """
+    if string[:1] != '{':
+        return parse_as_dict(string)
+    res = {}
+    pos = 1
+    while match := re_message_pair.match(string, pos):
+        key, string_val, int_val, const_val, keyword_val = match.groups()
+        if '\\' in key:
+            key = re_escape.sub(unescape, key)
+        if string_val is not None:
+            res[key] = re_escape.sub(unescape, string_val) if '\\' in string_val else string_val
+        elif int_val is not None:
+            res[key] = int(int_val)
+        elif const_val is not None:
+            res[key] = constants[const_val]
+        else:
+            res[key] = keyword_val
+        pos = match.end()
+    if (match := re_message_end.match(string, pos)) and match.end() == len(string):
+        return res
+    return parse_as_dict(string)
+
 def search(node, pos, pred = None, max_depth = 1000):
     """
     Search inside node what’s the deepest node that includes pos.
@@ -394,13 +807,82 @@ def search(node, pos, pred = None, max_depth = 1000):
 
 if __spec__.parent:
     import sublime, sublime_plugin
+    from . import cs_common
+
+cache = collections.OrderedDict() # Dict[Tuple[view_id, change_id, region], Tuple[str, Node]], least recently used first
+cache_size = 0 # total length of all texts in cache
+trees = {} # Dict[int, key], latest whole-buffer entry in cache per view, base for incremental re-parse
+edits = {} # Dict[int, Tuple[int, int, int]], changes since trees[view_id] as (start, old_end, new_end)
+hits = 0
+misses = 0
+
+def record_edit(view_id, a, b, length):
+    """
+    Merges replacement of [a, b) with `length` chars into edits[view_id]
+    """
+    if edit := edits.get(view_id):
+        start, old_end, new_end = edit
+        delta = length - (b - a)
+        end = new_end + delta if new_end >= b else a + length
+        # end - delta is the same point before this change, which is at or past new_end
+        edits[view_id] = (min(start, a), old_end + (end - delta) - new_end, end)
+    else:
+        edits[view_id] = (a, b, a + length)
+
+def cache_remove(key):
+    global cache_size
+    if (entry := cache.pop(key, None)) is not None:
+        cache_size -= len(entry[0])
+        if trees.get(key[0]) == key:
+            del trees[key[0]]
+            edits.pop(key[0], None)
+        return entry
+
+def cache_add(key, text, parsed):
+    """
+    Adds parse result to cache, evicting least recently used entries
+    until total size of cached texts fits into `parse_cache_size` setting
+    """
+    global cache_size
+    cache[key] = (text, parsed)
+    cache_size += len(text)
+    limit = cs_common.setting('parse_cache_size', 2000000)
+    while cache_size > limit and len(cache) > 1:
+        cache_remove(next(iter(cache)))
 
 def parse_tree(view, region = None):
     """
-    Parses current buffer content and return AST
+    Parses current buffer content (or region) and return AST. Results are
+    cached per view until it changes. Whole-buffer parses are incremental:
+    only top-level forms touched by edits since last parse are re-parsed.
+    Do not modify returned tree
     """
-    text = view.substr(region or sublime.Region(0, view.size()))
-    return parse(text)
+    global hits, misses
+    view_id = view.id()
+    key = (view_id, view.change_id(), (region.begin(), region.end()) if region else None)
+    if (entry := cache.get(key)) is not None:
+        cache.move_to_end(key)
+        hits += 1
+        return entry[1]
+
+    misses += 1
+    start_time = time.time()
+    if region:
+        text = view.substr(region)
+        parsed = parse(text)
+    else:
+        text = view.substr(sublime.Region(0, view.size()))
+        edit = edits.get(view_id)
+        if (base := trees.get(view_id)) and (entry := cache_remove(base)):
+            old_text, old_parsed = entry
+            start, old_end, new_end = edit_range(old_text, text, hint = edit)
+            parsed = reparse(old_parsed, old_text, text, start, old_end, new_end)
+        else:
+            parsed = parse(text)
+        trees[view_id] = key
+    cache_add(key, text, parsed)
+    cs_common.debug('Parsed {} chars in {:.2f} ms, parse cache hits: {}, misses: {}', len(text), (time.time() - start_time) * 1000, hits, misses)
+    return parsed
 
 def symbol_at_point(view, point):
     """
@@ -512,5 +994,46 @@ def defsym(node):
                 if is_symbol(second_form):
                     return second_form.text
 
+def form_hash(node, text):
+    """
+    Returns (key, hash) for a top-level form, text is the source node was parsed from.
+    Key is (def head, symbol) for defs, so a changed def replaces its previous version.
+    defmethod adds dispatch value, as many of them extend the same symbol.
+    Other forms are keyed by hash
+    """
+    h = hash(text[node.start:node.end])
+    if sym := defsym(node):
+        children = node.body.children
+        head = children[0].text
+        if head.endswith('defmethod') and len(children) >= 3:
+            return ((head, sym, text[children[2].start:children[2].end]), h)
+        return ((head, sym), h)
+    return (h, h)
+
+if __spec__.parent:
+    class EventListener(sublime_plugin.EventListener):
+        def on_close(self, view):
+            for key in [key for key in cache if key[0] == view.id()]:
+                cache_remove(key)
+
+    class TextChangeListener(sublime_plugin.TextChangeListener):
+        def on_text_changed(self, changes):
+            for view in self.buffer.views():
+                if view.id() in trees:
+                    for change in changes:
+                        record_edit(view.id(), change.a.pt, change.b.pt, len(change.str))
+
+def on_settings_change():
+    global engine
+    engine = cs_common.setting('parser_engine', 'combinators')
+
+def plugin_loaded():
+    cs_common.on_settings_change(__name__, on_settings_change)
+
 def plugin_unloaded():
-    parsed_cache = {}
+    global cache_size
+    cs_common.clear_settings_change(__name__)
+    cache.clear()
+    cache_size = 0
+    trees.clear()
+    edits.clear()
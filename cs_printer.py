@@ -1,95 +1,395 @@
 import re
 
-def safe_get(l, i, default = None):
-    """
-    Like dict.get(), but for lists
-    """
-    if i < len(l):
-        return l[i]
-    else:
-        return default
-
-def format_map(text, node, indent, limit):
-    """
-    Puts key-value pairs on separate line each. Aligns keys by longest one:
-    {:a 1 :bbb 2 :cc 3} => {:a   1
-                            :bbb 2
-                            :cc  3}
-    """
-    res = node.open.text
-    indent_keys = indent + len(node.open.text) * ' '
-    keys = []
-    vals = []
-    if node.body:
-        idxs = range(0, len(node.body.children), 2)
-        keys = [node.body.children[i] for i in idxs]
-        vals = [safe_get(node.body.children, i + 1) for i in idxs]
-    key_strings = [format(text, k, indent_keys, limit) for k in keys]
-    longest_key = max(len(ks) for ks in key_strings) if key_strings else 0
-    indent_vals = indent_keys + longest_key * ' ' + ' '
-    for i, ks, v in zip(range(0, len(keys)), key_strings, vals):
-        if i > 0:
-            res += '\n' + indent_keys
-        res += ks
-        if v is not None:
-            vs = format(text, v, indent_keys, limit)
-            if '\n' in vs:
-                res += '\n' + indent_keys + vs
-            elif len(indent_keys) + longest_key + 1 + len(vs) <= limit:
-                res += (longest_key - len(ks)) * ' ' + ' ' + vs
-            elif len(indent_keys) + len(ks) + 1 + len(vs) <= limit:
-                res += ' ' + vs
+if __spec__.parent:
+    from . import cs_parser
+else:
+    import cs_parser
+
+def size_of(s):
+    """
+    (length, has newlines, length of last line) of a string
+    """
+    return (len(s), '\n' in s, len(s) - s.rfind('\n') - 1)
+
+def concat(a, b):
+    """
+    Size of two strings written one after another
+    """
+    return (a[0] + b[0], a[1] or b[1], b[2] if b[1] else a[2] + b[2])
+
+class Printer:
+    """
+    Writes formatted text into a flat list of chunks, once. Instead of
+    re-measuring formatted strings, every node returns its size as numbers,
+    see size_of. Separator in front of a child is reserved as an empty chunk
+    and filled in after child is written and its size is known, so layout
+    is decided in the same single pass
+    """
+    def __init__(self, text, limit):
+        self.text     = text
+        self.limit    = limit
+        self.out      = []
+        self.newlines = {}
+
+    def newline(self, indent):
+        if (s := self.newlines.get(indent)) is None:
+            s = self.newlines[indent] = '\n' + indent * ' '
+        return s
+
+    def format_map(self, node, indent):
+        """
+        Puts key-value pairs on separate line each. Aligns keys by longest one:
+        {:a 1 :bbb 2 :cc 3} => {:a   1
+                                :bbb 2
+                                :cc  3}
+        """
+        out = self.out
+        open = node.open.text
+        out.append(open)
+        indent_keys = indent + len(open)
+        newline = self.newline(indent_keys)
+        children = node.body.children if node.body else []
+        pairs = []
+        for i in range(0, len(children), 2):
+            if i > 0:
+                out.append(newline)
+            key_size = self.format(children[i], indent_keys)
+            if i + 1 < len(children):
+                slot = len(out)
+                out.append('')
+                pairs.append((key_size, slot, self.format(children[i + 1], indent_keys)))
             else:
-                res += '\n' + indent_keys + vs
-    if node.close:
-        res += node.close.text
-    return res
+                pairs.append((key_size, None, None))
 
-def format_list(text, node, indent, limit):
-    """
-    Everythin list-like: (...), [...], #{...}
-    Puts as many children as it can on a line, then starts new one.
-    """
-    indent_children = indent + (len(node.open.text) * ' ')
-    res = node.open.text
-    force_newline = False
-    is_first = True
-    if node.body:
-        for i, child in enumerate(node.body.children):
-            if force_newline:
-                res += '\n' + indent_children
-                is_first = True
-            
-            child_str = format(text, child, indent_children, limit)
-            if '\n' in child_str or child.name in {'brackets', 'parens', 'braces'} or len(child_str) > limit / 3:
-                if not is_first:
-                    res += '\n' + indent_children
-                res += child_str
-                force_newline = True
-                is_first = True
-                continue
-            last_line = res[res.rfind('\n') + 1:]
-            separator = '' if is_first else ' '
-            if len(last_line) + len(separator) + len(child_str) > limit:
-                res += '\n' + indent_children + child_str
+        # Now that longest key is known, fill separators and sum up sizes
+        longest_key = max((key_size[0] for key_size, _, _ in pairs), default = 0)
+        length, multiline, last = len(open), False, len(open)
+        for i, ((key_length, key_multiline, key_last), slot, val_size) in enumerate(pairs):
+            if i > 0:
+                length, multiline, last = length + len(newline), True, indent_keys
+            length += key_length
+            if key_multiline:
+                multiline, last = True, key_last
             else:
-                res += separator + child_str
-            force_newline = False
-            is_first = False
-    close = node.close.text if node.close else ''
-    res += close
-    return res
+                last += key_length
+            if slot is not None:
+                val_length, val_multiline, val_last = val_size
+                if val_multiline:
+                    separator = newline
+                elif indent_keys + longest_key + 1 + val_length <= self.limit:
+                    separator = (longest_key - key_length) * ' ' + ' '
+                elif indent_keys + key_length + 1 + val_length <= self.limit:
+                    separator = ' '
+                else:
+                    separator = newline
+                out[slot] = separator
+                if separator is newline:
+                    length, multiline, last = length + len(newline), True, indent_keys
+                else:
+                    length, last = length + len(separator), last + len(separator)
+                length += val_length
+                if val_multiline:
+                    multiline, last = True, val_last
+                else:
+                    last += val_length
+        if node.close:
+            out.append(node.close.text)
+            length, last = length + len(node.close.text), last + len(node.close.text)
+        return (length, multiline, last)
+
+    def format_list(self, node, indent):
+        """
+        Everythin list-like: (...), [...], #{...}
+        Puts as many children as it can on a line, then starts new one.
+        """
+        out = self.out
+        limit = self.limit
+        open = node.open.text
+        out.append(open)
+        indent_children = indent + len(open)
+        newline = self.newline(indent_children)
+        # last is the length of the current last line
+        length, multiline, last = len(open), False, len(open)
+        force_newline = False
+        is_first = True
+        if node.body:
+            for child in node.body.children:
+                if force_newline:
+                    out.append(newline)
+                    length, multiline, last = length + len(newline), True, indent_children
+                    is_first = True
+
+                slot = len(out)
+                out.append('')
+                child_length, child_multiline, child_last = self.format(child, indent_children)
+                if child_multiline or child.name in {'brackets', 'parens', 'braces'} or child_length > limit / 3:
+                    separator = '' if is_first else newline
+                    force_newline = True
+                    is_first = True
+                else:
+                    separator = '' if is_first else ' '
+                    if last + len(separator) + child_length > limit:
+                        separator = newline
+                    force_newline = False
+                    is_first = False
+                if separator is newline:
+                    out[slot] = newline
+                    length, multiline, last = length + len(newline), True, indent_children
+                elif separator:
+                    out[slot] = separator
+                    length, last = length + 1, last + 1
+                length += child_length
+                if child_multiline:
+                    multiline, last = True, child_last
+                else:
+                    last += child_length
+        if node.close:
+            out.append(node.close.text)
+            length, last = length + len(node.close.text), last + len(node.close.text)
+        return (length, multiline, last)
+
+    def format_tagged(self, node, indent):
+        """
+        #tag <some_value>
+        """
+        self.out.append('#')
+        tag_size = self.format(node.tag, indent)
+        size = concat(size_of('#'), tag_size)
+        if node.body:
+            self.out.append(' ')
+            size = concat(size, size_of(' '))
+            value_indent = indent + 1 + tag_size[0] + 1
+            size = concat(size, self.format(node.body.children[0], value_indent))
+        return size
 
-def format_tagged(text, node, indent, limit):
+    def format_token(self, node, indent):
+        str = self.text[node.start:node.end]
+        if '\\n' in str:
+            str = re.sub("(?<!\\\\)\\\\n", "\n", str)
+        space = self.limit - indent
+        if '\n' in str or (len(str) > space and space >= 10):
+            str = "\n".join(wrap_string(s, limit = self.limit, indent = indent * ' ') for s in str.split("\n"))
+        self.out.append(str)
+        if '\n' in str:
+            return size_of(str)
+        return (len(str), False, len(str))
+
+    def format(self, node, indent):
+        """
+        Writes node to self.out, returns its size
+        """
+        if node.name == 'source':
+            size = size_of('')
+            for i, child in enumerate(node.children):
+                if i > 0:
+                    self.out.append('\n')
+                    size = concat(size, size_of('\n'))
+                size = concat(size, self.format(child, 0))
+            return size
+        elif node.name == 'braces' and node.open.text != '#{':
+            return self.format_map(node, indent)
+        elif node.name in {'parens', 'brackets', 'braces'}:
+            return self.format_list(node, indent)
+        elif node.name == 'tagged':
+            return self.format_tagged(node, indent)
+        else:
+            return self.format_token(node, indent)
+
+def cut_string(node):
     """
-    #tag <some_value>
+    Does node end with a string without closing quote. Outside of end of text,
+    that happens when string is cut right after a backslash
     """
-    tag_string = format(text, node.tag, indent, limit)
-    res = '#' + tag_string
-    if node.body:
-        value_indent = indent + ' ' + len(tag_string) * ' ' + ' '
-        res += ' ' + format(text, node.body.children[0], value_indent, limit)
-    return res
+    while node.children:
+        if node.name == 'string':
+            return node.children[-1].name != '.close'
+        node = node.children[-1]
+    return False
+
+class Spine:
+    """
+    List-like collection StreamPrinter is in the middle of. Same state
+    as Printer.format_list keeps while going over children
+    """
+    __slots__ = ('closer', 'indent_children', 'newline', 'length', 'multiline', 'last', 'force_newline', 'is_first')
+
+    def __init__(self, open, closer, indent):
+        self.closer          = closer
+        self.indent_children = indent + len(open)
+        self.newline         = '\n' + self.indent_children * ' '
+        self.length          = len(open)
+        self.multiline       = False
+        self.last            = len(open)
+        self.force_newline   = False
+        self.is_first        = True
+
+    def add(self, text, size = None):
+        """
+        Accounts for text written at the end of collection
+        """
+        length, multiline, last = size or size_of(text)
+        self.length += length
+        if multiline:
+            self.multiline, self.last = True, last
+        else:
+            self.last += length
+
+class StreamPrinter:
+    """
+    Pretty-prints text fed in chunks, with exactly the same result as
+    `format` of the whole text. Lines are returned as soon as they are complete.
+
+    Lists, vectors and sets on the way from the top level (the spine) are
+    laid out child by child, same way as Printer.format_list does. Anything
+    else, e.g. a map or a number inside them, is parsed and formatted by Printer
+    once it's complete. Only unfinished child is kept in memory. That means
+    a map shows up only when complete, as its key alignment depends on all keys
+    """
+    def __init__(self, limit = 80):
+        self.limit    = limit
+        self.buffer   = ''
+        self.retry_at = 0     # buffer length to try parsing unfinished child again
+        self.stack    = []    # [Spine]
+        self.count    = 0     # top-level forms written
+        self.line     = []
+        self.lines    = []
+        self.written  = False
+
+    def emit(self, text):
+        if '\n' in text:
+            parts = text.split('\n')
+            self.line.append(parts[0])
+            self.lines.append(''.join(self.line))
+            self.lines.extend(parts[1:-1])
+            self.line = [parts[-1]]
+        else:
+            self.line.append(text)
+        self.written = True
+
+    def separate(self, collection, length = 0, multiline = False):
+        """
+        Writes separator in front of the next child, exactly as
+        Printer.format_list or top level of Printer.format would
+        """
+        if not self.stack:
+            if self.count > 0:
+                self.emit('\n')
+            self.count += 1
+            return
+        spine = self.stack[-1]
+        if spine.force_newline:
+            self.emit(spine.newline)
+            spine.add(spine.newline)
+            spine.is_first = True
+        if multiline or collection or length > self.limit / 3:
+            separator = '' if spine.is_first else spine.newline
+            spine.force_newline = True
+            spine.is_first = True
+        else:
+            separator = '' if spine.is_first else ' '
+            if spine.last + len(separator) + length > self.limit:
+                separator = spine.newline
+            spine.force_newline = False
+            spine.is_first = False
+        if separator:
+            self.emit(separator)
+            spine.add(separator)
+
+    def close(self, closer = ''):
+        spine = self.stack.pop()
+        if closer:
+            self.emit(closer)
+            spine.add(closer)
+        if self.stack:
+            self.stack[-1].add(None, (spine.length, spine.multiline, spine.last))
+
+    def child(self, node, text):
+        """
+        Formats finished child with Printer
+        """
+        indent = self.stack[-1].indent_children if self.stack else 0
+        printer = Printer(text, self.limit)
+        try:
+            size = printer.format(node, indent)
+            formatted = ''.join(printer.out)
+        except RecursionError:
+            formatted = text[node.start:node.end]
+            size = size_of(formatted)
+        self.separate(node.name in {'brackets', 'parens', 'braces'}, size[0], size[1])
+        self.emit(formatted)
+        if self.stack:
+            self.stack[-1].add(formatted, size)
+
+    def consume(self, final):
+        buffer = self.buffer
+        length = len(buffer)
+        if not final and length < self.retry_at:
+            return
+        pos = 0
+        while pos < length:
+            spine = self.stack[-1] if self.stack else None
+            if spine and buffer[pos] == spine.closer:
+                self.close(spine.closer)
+                pos += 1
+                continue
+            match = cs_parser.re_scan_item.match(buffer, pos)
+            if match and match.lastgroup == 'ws':
+                pos = match.end()
+                continue
+            if match and (match.lastgroup in {'parens', 'brackets'} or match.group() == '#{') and match.end() < length:
+                open = match.group()
+                self.separate(True)
+                self.emit(open)
+                self.stack.append(Spine(open, cs_parser.closers[match.lastgroup], spine.indent_children if spine else 0))
+                pos = match.end()
+                continue
+            node = next(cs_parser.scan(buffer, pos), None)
+            if node is None:
+                pos = length
+                break
+            # Child is complete once something after it is known too. Prefix forms
+            # like ' or #tag cut by the end of buffer fail and become 1-char errors,
+            # so such errors are only trusted at the very end
+            if not final and (node.end >= length or (node.name == 'error' and buffer[node.start] not in ')]}') or cut_string(node)):
+                self.retry_at = 2 * (length - pos)
+                break
+            self.child(node, buffer)
+            pos = node.end
+        self.buffer = buffer[pos:]
+        if pos >= length:
+            self.retry_at = 0
+
+    def feed(self, chunk):
+        """
+        Returns list of lines completed by `chunk`
+        """
+        self.buffer += chunk
+        self.consume(False)
+        lines, self.lines = self.lines, []
+        return lines
+
+    def finish(self):
+        """
+        Returns remaining lines. Unclosed collections stay unclosed, as in `format`
+        """
+        self.consume(True)
+        while self.stack:
+            self.close()
+        if self.written:
+            self.lines.append(''.join(self.line))
+            self.line = []
+            self.written = False
+        lines, self.lines = self.lines, []
+        return lines
+
+def format_lines(chunks, limit = 80):
+    """
+    Generator of lines of StreamPrinter output, formatted as chunks of text are consumed
+    """
+    printer = StreamPrinter(limit)
+    for chunk in chunks:
+        yield from printer.feed(chunk)
+    yield from printer.finish()
 
 def wrap_string(s, limit = 80, indent = ''):
     space = limit - len(indent)
@@ -110,16 +410,15 @@ def format(text, node, indent = '', limit = 80):
     """
     Given text and its parsed AST as node, returns formatted (pretty-printed) string of that node
     """
-    if node.name == 'source':
-        return '\n'.join(format(text, n, '', limit) for n in node.children)
-    elif node.name == 'braces' and node.open.text != '#{':
-        return format_map(text, node, indent, limit)
-    elif node.name in {'parens', 'brackets', 'braces'}:
-        return format_list(text, node, indent, limit)
-    elif node.name == 'tagged':
-        return format_tagged(text, node, indent, limit)
-    else:
-        str = text[node.start:node.end]
-        str = re.sub("(?<!\\\\)\\\\n", "\n", str)
-        str = "\n".join(wrap_string(s, limit = limit, indent = indent) for s in str.split("\n"))
-        return str
+    printer = Printer(text, limit)
+    printer.format(node, len(indent))
+    return ''.join(printer.out)
+
+def format_value(text, node, limit = 80):
+    """
+    Same as format, but returns text as-is if it’s nested too deep to pretty-print
+    """
+    try:
+        return format(text, node, limit = limit)
+    except RecursionError:
+        return text
@@ -1,6 +1,9 @@
-import sublime, sublime_plugin, threading, time
+import math, sublime, sublime_plugin, threading, time
 from . import cs_common, cs_eval
 
+pending_key = f"{cs_common.ns}.pending"
+evals_per_interval = 100 # with more pending evals, spinner ticks proportionally slower
+
 class ProgressThread:
     """
     Thread that updates all pending evals spinners.
@@ -27,19 +30,34 @@ class ProgressThread:
     def phase(self):
         return self.phases[self.phase_idx]
 
+    def draw(self, view):
+        """
+        Spinners of all pending evals in a view share one region key,
+        so a tick is a single add_regions call. Returns number of pending evals.
+        Runs on progress thread: reads a copy of the index, taken under its lock,
+        and doesn’t create an index for views that have none
+        """
+        index = cs_eval.regions_by_view.get(view.id())
+        regions = [region for eval, region in index.regions() if eval.status == 'pending'] if index else []
+        if regions:
+            scope, color = cs_common.scope_color(view, 'pending')
+            annotations = [cs_common.escape(self.phase())] * len(regions)
+            view.add_regions(pending_key, regions, scope, '', sublime.DRAW_NO_FILL + sublime.DRAW_NO_OUTLINE + sublime.NO_UNDO, annotations, color)
+        else:
+            view.erase_regions(pending_key)
+        return len(regions)
+
     def run_loop(self):
         thread.update_phases(cs_common.setting("progress_phases"), cs_common.setting("progress_interval_ms"))
         while True:
             if not self.running:
                 break
-            time.sleep(self.interval / 1000.0)
-            updated = False
+            pending = 0
             if (window := sublime.active_window()) and (view := window.active_view()):
-                for eval in cs_eval.by_status(view, 'pending'):
-                    eval.update(eval.status, self.phase())
-                    updated = True
-            if updated:
+                pending = self.draw(view)
+            if pending:
                 self.phase_idx = (self.phase_idx + 1) % len(self.phases)
+                time.sleep(self.interval * math.ceil(pending / evals_per_interval) / 1000.0)
             else:
                 with self.condition:
                     self.condition.wait()
@@ -67,6 +85,12 @@ def phase():
 def wake():
     thread.wake()
 
+def refresh(view):
+    """
+    Redraw spinners after some pending eval got result or was erased
+    """
+    thread.draw(view)
+
 class EventListener(sublime_plugin.EventListener):
     def on_activated_async(self, view):
         """
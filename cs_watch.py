@@ -3,6 +3,7 @@ from . import cs_common, cs_conn, cs_parser, cs_printer
 
 watches = {} # Dict[int, Watch]
 watches_by_view = collections.defaultdict(dict) # Dict[int, Dict[int, Watch]]
+regions_by_view = collections.defaultdict(cs_common.RegionIndex) # Dict[int, RegionIndex]
 
 class Watch:
     last_id: int = 0
@@ -17,19 +18,22 @@ class Watch:
     def value(self):
         return self.values[-1] if len(self.values) > 0 else None
 
-    def update_region(self):
-        regions = self.view.get_regions(self.region_key())
-        if regions and len(regions) >= 1:
-            self.region = regions[0]
+    @property
+    def region(self):
+        """
+        Read from the index on demand, so edits don’t copy regions into every watch
+        """
+        return regions_by_view[self.view.id()].region(self)
 
     def __init__(self, view, region):
         self.id         = Watch.next_id()
         self.view       = view
-        self.region     = region
         self.values     = collections.deque(maxlen = 10)
         self.phantom_id = None
+        self.phantom_texts = {} # Dict[int, PhantomText], wrap width -> text
         watches[self.id] = self
         watches_by_view[view.id()][self.id] = self
+        regions_by_view[view.id()].add(self, region)
         self.update(recursive = False)
 
     def __lt__(self, other):
@@ -39,11 +43,12 @@ class Watch:
         view = self.view
         if value is not None:
             self.values.append(value)
+            self.phantom_texts.clear()
         scope, color = cs_common.scope_color(self.view, 'watch')
         view.erase_regions(self.region_key())
 
         line = view.line(self.region)
-        same_line_watches = list(w for w in watches_by_view[view.id()].values() if view.line(w.region) == line)
+        same_line_watches = list(w for w, _ in regions_by_view[view.id()].find(line) if view.line(w.region) == line)
         same_line_watches.sort()
         if same_line_watches[0] == self:
             display = " · ".join(cs_common.escape(w.value()) for w in same_line_watches if w.value())
@@ -71,6 +76,7 @@ class Watch:
             self.view.erase_phantom_by_id(self.phantom_id)
         del watches[self.id]
         del watches_by_view[self.view.id()][self.id]
+        regions_by_view[self.view.id()].remove(self)
 
     def toggle(self):
         if self.value() is None:
@@ -81,14 +87,6 @@ class Watch:
             self.phantom_id = None
             return
 
-        limit = cs_common.wrap_width(self.view)
-
-        string = ""
-        for index, value in enumerate(reversed(self.values)):
-            node   = cs_parser.parse(value)
-            prefix = f" i-{index}" if index > 0 else "last"
-            string += f"{prefix}: {cs_printer.format(value, node, limit = limit)}\n"
-
         styles  = """
             .light body { background-color: hsl(285, 100%, 90%); }
             .dark body  { background-color: hsl(285, 100%, 10%); }
@@ -96,23 +94,29 @@ class Watch:
         if phantom_styles := cs_common.phantom_styles(self.view, "phantom_success"):
             styles += f".light body, .dark body {{ { phantom_styles }; border: 4px solid #CC33CC; }}"
 
-        body = f"""<body id='clojure-sublimed'>
-            { cs_common.basic_styles(self.view) }
-            { styles }
-        </style>"""
-        
-        for line in string.splitlines():
-            line = cs_printer.wrap_string(line, limit = limit)
-            line = cs_common.escape(line)
-            body += "<p>" + line + "</p>"
-        body += "</body>"
+        self.show_phantom(self.phantom_text(), styles)
+
+    def phantom_text(self):
+        """
+        PhantomText of all values, cached per wrap width until next value arrives
+        """
+        limit = cs_common.wrap_width(self.view)
+        if not (text := self.phantom_texts.get(limit)):
+            string = ""
+            for index, value in enumerate(reversed(self.values)):
+                node   = cs_parser.parse(value)
+                prefix = f" i-{index}" if index > 0 else "last"
+                string += f"{prefix}: {cs_printer.format_value(value, node, limit = limit)}\n"
+            text = cs_common.PhantomText(string, lambda line: cs_printer.wrap_string(line, limit = limit))
+            self.phantom_texts[limit] = text
+        return text
+
+    def show_phantom(self, text, styles, count = None):
+        if self.phantom_id:
+            self.view.erase_phantom_by_id(self.phantom_id)
         point = self.view.line(self.region.end()).begin()
-        self.phantom_id = self.view.add_phantom(
-            key = self.region_key(),
-            region = sublime.Region(point, point),
-            content = body,
-            layout = sublime.LAYOUT_BLOCK
-        )
+        on_more = lambda count: self.show_phantom(text, styles, count)
+        self.phantom_id = cs_common.add_text_phantom(self.view, self.region_key(), point, styles, text, count, on_more)
 
 def on_watch(id, value):
     if w := watches.get(id):
@@ -127,9 +131,8 @@ def erase_watches(predicate = lambda x: True, view = None):
         w.erase()
 
 def by_region(view, region):
-    for w in watches_by_view[view.id()].values():
-        if cs_common.regions_touch(w.region, region):
-            return w
+    for w, _ in regions_by_view[view.id()].find(region):
+        return w
 
 def transform(view):
     def transform_impl(code, **kwargs):
@@ -177,25 +180,27 @@ class ClojureSublimedAddWatchCommand(sublime_plugin.TextCommand):
 class EventListener(sublime_plugin.EventListener):
     def on_pre_close(self, view):
         erase_watches(view = view)
+        regions_by_view.pop(view.id(), None)
 
 class TextChangeListener(sublime_plugin.TextChangeListener):
+    def on_text_changed(self, changes):
+        for view in self.buffer.views():
+            if view.id() in regions_by_view:
+                regions_by_view[view.id()].shift(view, cs_common.changes_deltas(changes))
+
     def on_text_changed_async(self, changes):
         view    = self.buffer.primary_view()
+        index   = regions_by_view[view.id()]
         changed = [sublime.Region(x.a.pt, x.b.pt) for x in changes]
-        
-        def should_erase(w):
-            return any(w.region.intersects(r) for r in changed)
-        erase_watches(should_erase, view)
-        
-        lines = list(view.line(r) for r in changed)
-        def should_update(w):
-            return any(r.contains(w.region.begin()) for r in lines)
-        need_update = list(w for w in watches_by_view[view.id()].values() if should_update(w))
 
-        for w in watches_by_view[view.id()].values():
-            w.update_region()
+        to_erase = {w.id: w for r in changed for w, region in index.find(r) if region.intersects(r)}
+        for w in to_erase.values():
+            if w.id in watches:
+                w.erase()
 
-        for w in need_update:
+        lines = list(view.line(r) for r in changed)
+        need_update = {w.id: w for r in lines for w, region in index.find(r) if r.contains(region.begin())}
+        for w in need_update.values():
             w.update(recursive = False)
 
 def plugin_unloaded():
@@ -0,0 +1,45 @@
+#! /usr/bin/env python3
+import os, random, sys, time
+
+cwd = os.path.abspath(os.path.dirname(__file__))
+os.chdir(cwd + "/..")
+sys.path.append(os.getcwd())
+import cs_bencode
+import script.test_bencode as test_bencode
+
+session = 'a6f3c4e2-5b1d-4f0e-9c7a-2d8e1b3f4a5c'
+line = '{:user/id 12345, :user/name "Nikita", :user/tags #{:a :b :c}, :user/score 3.14}\n'
+
+def messages():
+    """
+    Realistic mix: status messages, a big pprinted value, long out stream
+    """
+    status = [{'id': str(i), 'session': session, 'status': ['done']} for i in range(10000)]
+    value = [{'id': '10000', 'session': session, 'ns': 'user', 'value': line * (10 * 1024 * 1024 // len(line))}]
+    out = [{'id': '10001', 'session': session, 'out': 'Processing item {} of 20000 — ok\n'.format(i)} for i in range(20000)]
+    return {'status': status, '10 MB value': value, 'out': out, 'all': status + value + out}
+
+def bench(name, codec, msgs, encode, decode):
+    start = time.time()
+    encoded = [encode(msg) for msg in msgs]
+    encode_time = time.time() - start
+    data = b''.join(encoded)
+    start = time.time()
+    decoded = decode(data)
+    decode_time = time.time() - start
+    assert decoded == msgs
+    mb = len(data) / 1024 / 1024
+    print("{:<12} {:<10} encode {:7.1f} MB/s {:8.0f} msg/s, decode {:7.1f} MB/s {:8.0f} msg/s".format(
+        name, codec, mb / encode_time, len(msgs) / encode_time, mb / decode_time, len(msgs) / decode_time))
+
+def decode_chunked(data):
+    decoder = cs_bencode.Decoder()
+    res = []
+    for pos in range(0, len(data), 65536):
+        res += decoder.feed(data[pos:pos + 65536])
+    return res
+
+if __name__ == '__main__':
+    for name, msgs in messages().items():
+        bench(name, 'reference', msgs, test_bencode.reference_encode, test_bencode.reference_decode)
+        bench(name, 'current', msgs, cs_bencode.encode, decode_chunked)
@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+import os, random, re, sys, time
+
+cwd = os.path.abspath(os.path.dirname(__file__))
+os.chdir(cwd + "/..")
+sys.path.append(os.getcwd())
+import cs_colors
+
+def colored_log(size):
+    """
+    Test runner-like output (kaocha, eftest): escape-heavy, mostly short colored words
+    """
+    random.seed(42)
+    lines = []
+    length = 0
+    while length < size:
+        i = len(lines)
+        kind = random.random()
+        if kind < 0.6:
+            line = "\x1b[32m.\x1b[0m" * random.randint(10, 60)
+        elif kind < 0.8:
+            line = "\x1b[1;31mFAIL\x1b[0m in \x1b[36m(test-{} )\x1b[0m (core_test.clj:{})".format(i, i % 500)
+        elif kind < 0.9:
+            line = "expected: \x1b[33m(= {} (inc x))\x1b[0m\n  actual: \x1b[31m(not (= {} {}))\x1b[m".format(i, i, i + 1)
+        else:
+            line = "\x1b[2K\x1b[1G\x1b[34mRan {} tests containing {} assertions.\x1b[39m \x1b[41;97m{} failures\x1b[49;39m".format(i, i * 3, i % 7)
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines) + "\n"
+
+# Previous implementation: multiple passes per escape, one region per word
+RE_UNKNOWN_ESCAPES = re.compile(r"\x1b[^a-zA-Z]*[a-zA-Z]")
+RE_COLOR_ESCAPES = re.compile(r"\x1b\[((?:;?\d+)*)m")
+
+def reference_decolorize(characters):
+    decolorized = ""
+    original_pos = 0
+    decolorized_pos = 0
+    fg = "default"
+    bg = "default"
+    spans = {}
+    def iteration(start, end, group):
+        nonlocal decolorized, original_pos, decolorized_pos, fg, bg
+        text = characters[original_pos:start]
+        text = RE_UNKNOWN_ESCAPES.sub("", text)
+        decolorized += text
+        if scope := cs_colors.SCOPES.get(bg, None) or cs_colors.SCOPES.get(fg, None):
+            for m in cs_colors.RE_NOTSPACE.finditer(text):
+                spans.setdefault(scope, []).append((decolorized_pos + m.start(), decolorized_pos + m.end()))
+        for digit in re.findall(r"\d+", group) or ["0"]:
+            digit = int(digit)
+            if digit in cs_colors.FG_ANSI:
+                fg = cs_colors.FG_ANSI[digit]
+            if digit in cs_colors.BG_ANSI:
+                bg = cs_colors.BG_ANSI[digit]
+            if digit == 0:
+                fg = 'default'
+                bg = 'default'
+        original_pos = end
+        decolorized_pos += len(text)
+    for m in RE_COLOR_ESCAPES.finditer(characters):
+        iteration(m.start(), m.end(), m.group(1))
+    iteration(len(characters), len(characters), "")
+    return decolorized, spans
+
+def colored_chars(spans):
+    return {scope: {i for start, end in scope_spans for i in range(start, end)} for scope, scope_spans in spans.items()}
+
+def bench(name, fn, log):
+    times = []
+    for _ in range(3):
+        start = time.time()
+        text, spans = fn(log)
+        times.append(time.time() - start)
+    regions = sum(len(s) for s in spans.values())
+    print("{:<9} {:.1f} MB in {:.2f} ms, {:.1f} MB/s, {} regions".format(
+        name, len(log) / 1024 / 1024, min(times) * 1000, len(log) / 1024 / 1024 / min(times), regions))
+    return text, spans
+
+if __name__ == '__main__':
+    log = colored_log(1024 * 1024)
+    expected_text, expected_spans = bench('reference', reference_decolorize, log)
+    actual_text, actual_spans = bench('current', cs_colors.decolorize, log)
+    assert expected_text == actual_text
+    assert colored_chars(expected_spans) == colored_chars(actual_spans)
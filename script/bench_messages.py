@@ -0,0 +1,34 @@
+#! /usr/bin/env python3
+import os, sys, time
+
+cwd = os.path.abspath(os.path.dirname(__file__))
+os.chdir(cwd + "/..")
+sys.path.append(os.getcwd())
+import cs_parser
+
+def escape(s):
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def messages():
+    """
+    What socket_repl.clj sends: lots of small messages, few large values
+    """
+    value = escape('{:user/id 12345, :user/name "Nikita", :user/tags #{:a :b :c}}\n' * 16000)
+    trace = escape('\tat clojure.lang.Compiler.eval(Compiler.java:7194)\n' * 100)
+    return {
+        'done':  ['{"id" %d, "tag" "done"}' % i for i in range(10000)],
+        'ret':   ['{"form" "(+ 1 2)", "from_column" 1, "from_line" %d, "id" %d, "idx" 0, "tag" "ret", "time" 0, "to_column" 8, "to_line" %d, "val" "3"}' % (i, i, i) for i in range(10000)],
+        'out':   ['{"id" %d, "tag" "out", "val" "Processing item %d of 10000\\n"}' % (i, i) for i in range(10000)],
+        'ex':    ['{"id" %d, "idx" 0, "line" 12, "column" 3, "source" "core.clj", "tag" "ex", "trace" "%s", "val" "Boom"}' % (i, trace) for i in range(100)],
+        '1 MB val': ['{"id" 1, "idx" 0, "tag" "ret", "time" 10, "val" "%s"}' % value],
+    }
+
+if __name__ == '__main__':
+    for name, msgs in messages().items():
+        size = sum(len(msg) for msg in msgs)
+        for reader in [cs_parser.parse_as_dict, cs_parser.read_message]:
+            start = time.time()
+            for msg in msgs:
+                reader(msg)
+            elapsed = time.time() - start
+            print("{:<9} {:<13} {:6} msgs in {:8.2f} ms, {:7.1f} MB/s".format(name, reader.__name__, len(msgs), elapsed * 1000, size / 1024 / 1024 / elapsed))
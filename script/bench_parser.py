@@ -7,9 +7,14 @@ sys.path.append(os.getcwd())
 import cs_parser
 
 if __name__ == '__main__':
-    start = time.time()
     dir = cwd + "/../test_parser/"
     with open(dir + 'core.clj') as f:
         expr = f.read()
-    parsed = cs_parser.parse(expr)
-    print("Parsed {}..{} in {} ms". format(parsed.start, parsed.end, (time.time() - start) * 1000))
+    for engine in ['combinators', 'scanner']:
+        cs_parser.engine = engine
+        times = []
+        for _ in range(5):
+            start = time.time()
+            parsed = cs_parser.parse(expr)
+            times.append((time.time() - start) * 1000)
+        print("{:<11} parsed {}..{} in {:.2f} ms (best of 5)". format(engine, parsed.start, parsed.end, min(times)))
@@ -0,0 +1,40 @@
+#! /usr/bin/env python3
+import itertools, os, sys, time
+
+cwd = os.path.abspath(os.path.dirname(__file__))
+os.chdir(cwd + "/..")
+sys.path.append(os.getcwd())
+import cs_parser, cs_printer
+import script.test_printer as test_printer
+
+def values():
+    """
+    ~1 MB EDN values: one wide vector, a vector of maps as a typical query result,
+    and the same vector nested deep in maps
+    """
+    wide = '[' + ' '.join(str(i) for i in range(150000)) + ']'
+    row = '{{:user/id {}, :user/name "Nikita", :user/tags #{{:a :b :c}}, :user/score 3.14, :user/address {{:city "Berlin" :zip "10115"}}}}'
+    rows = '[' + ' '.join(row.format(i) for i in range(1024 * 1024 // len(row))) + ']'
+    nested = rows
+    for i in range(20):
+        nested = '{{:level {} :data {}}}'.format(i, nested)
+    return {'wide vector': wide, 'vector of maps': rows, 'nested maps': nested}
+
+def bench(name, impl, printer, text, node):
+    times = []
+    for _ in range(3):
+        start = time.time()
+        res = printer(text, node, limit = 80)
+        times.append((time.time() - start) * 1000)
+    print("{:<15} {:<10} {:.1f} MB in {:6.0f} ms (best of 3)".format(name, impl, len(text) / 1024 / 1024, min(times)))
+    return res
+
+if __name__ == '__main__':
+    for name, text in values().items():
+        node = cs_parser.parse(text)
+        expected = bench(name, 'reference', test_printer.reference_format, text, node)
+        actual = bench(name, 'current', cs_printer.format, text, node)
+        assert expected == actual
+        chunks = [text[i:i + 4096] for i in range(0, len(text), 4096)]
+        bench(name, 'stream', lambda text, node, limit: list(cs_printer.format_lines(chunks, limit = limit)), text, node)
+        bench(name, 'stream 100', lambda text, node, limit: list(itertools.islice(cs_printer.format_lines(chunks, limit = limit), 100)), text, node)
@@ -241,11 +241,22 @@ class Selection:
     #     return sublime_api.view_selection_contains(self.view_id, region.a, region.b)
 
 class View:
+    last_id = 0
+
     def __init__(self, text="", sel = None):
+        View.last_id += 1
+        self._id = View.last_id
+        self._change_id = 0
         self.text = text
         self.text_lines = text.split('\n')
         self._sel = Selection(sel) if sel else Selection([Region(0, 0)])
 
+    def id(self):
+        return self._id
+
+    def change_id(self):
+        return (self._change_id, 0, 0)
+
     def sel(self):
         return self._sel
 
@@ -275,6 +286,7 @@ class View:
     def replace(self, edit, region, new_text):
         self.text = self.text[:region.begin()] + new_text + self.text[region.end():]
         self.text_lines = self.text.split('\n')
+        self._change_id += 1
 
     def lines(self, region):
         start = 0
@@ -293,6 +305,20 @@ def platform() -> Literal["osx", "linux", "windows"]:
     """
     return platform
 
+class Settings:
+    def get(self, key, default = None):
+        return default
+
+class Window:
+    def active_view(self):
+        return None
+
+def active_window():
+    return Window()
+
+def load_settings(name):
+    return Settings()
+
 def error_message(msg: str):
     """ Display an error dialog. """
     print('ERROR:', msg, file = sys.stderr, flush = True)
@@ -1,6 +1,22 @@
 class EventListener:
     pass
 
+class TextChangeListener:
+    pass
+
 class TextCommand:
     def __init__(self, view):
         self.view: sublime.View = view
+
+class WindowCommand:
+    def __init__(self, window):
+        self.window = window
+
+class ViewEventListener:
+    pass
+
+class TextInputHandler:
+    pass
+
+class ListInputHandler:
+    pass
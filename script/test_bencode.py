@@ -0,0 +1,225 @@
+#! /usr/bin/env python3
+import numbers, os, random, sys
+from io import BytesIO
+
+cwd = os.path.dirname(__file__)
+os.chdir(os.path.abspath(cwd + "/.."))
+sys.path.append(os.getcwd())
+import cs_bencode
+import script.test_core as test_core
+
+# Reference codec: byte-at-a-time implementation cs_bencode started from.
+# Faster codecs must produce the same bytes and the same values
+
+def reference_read_int(s, terminator = None, init_data = None):
+    int_chrs = init_data or []
+    while True:
+        c = s.read(1)
+        if not (c.isdigit() or c == b'-') or c == terminator or not c:
+            break
+        else:
+            int_chrs.append(c)
+    return int(b''.join(int_chrs))
+
+def reference_read_datum(s):
+    delim = s.read(1)
+    if delim.isdigit():
+        delim = reference_read_int(s, ":", [delim])
+    if delim == b'':
+        return None
+    elif delim == b'i':
+        return reference_read_int(s)
+    elif delim == b'l' or delim == b'd':
+        data = []
+        while (datum := reference_read_datum(s)) is not None:
+            data.append(datum)
+        if delim == b'd':
+            i = iter(data)
+            return dict(zip(i, i))
+        return data
+    elif delim == b'e':
+        return None
+    else:
+        return reference_read_bytes(s, delim)
+
+class ReferenceSocketIO:
+    """
+    Reads N bytes at a time from 4096-byte recv chunks, like cs_common.SocketIO did
+    """
+    def __init__(self, bytes):
+        self.file = BytesIO(bytes)
+        self.buffer = None
+        self.pos = -1
+
+    def read(self, n):
+        if not self.buffer or self.pos >= len(self.buffer):
+            self.buffer = self.file.read(4096)
+            self.pos = 0
+        begin = self.pos
+        end = min(begin + n, len(self.buffer))
+        self.pos = end
+        return self.buffer[begin:end]
+
+def reference_read_bytes(s, n):
+    data = BytesIO()
+    cnt = 0
+    while cnt < n:
+        m = s.read(n - cnt)
+        if not m:
+            raise Exception("Invalid bytestring, unexpected end of input.")
+        data.write(m)
+        cnt += len(m)
+    return data.getvalue().decode('utf-8')
+
+def reference_decode(bytes):
+    s = ReferenceSocketIO(bytes)
+    res = []
+    while (datum := reference_read_datum(s)) is not None:
+        res.append(datum)
+    return res
+
+def reference_write_datum(x, out):
+    if isinstance(x, str):
+        out.write(str(len(x.encode('utf-8'))).encode('utf-8'))
+        out.write(b":")
+        out.write(x.encode('utf-8'))
+    elif isinstance(x, numbers.Integral):
+        out.write(b"i")
+        out.write(str(x).encode('utf-8'))
+        out.write(b"e")
+    elif isinstance(x, (list, tuple)):
+        out.write(b"l")
+        for v in x:
+            reference_write_datum(v, out)
+        out.write(b"e")
+    elif isinstance(x, dict):
+        out.write(b"d")
+        for k, v in x.items():
+            reference_write_datum(k, out)
+            reference_write_datum(v, out)
+        out.write(b"e")
+
+def reference_encode(v):
+    s = BytesIO()
+    reference_write_datum(v, s)
+    return s.getvalue()
+
+alphabet = 'abc xyz:ie0123456789-\n\\"é€𝄞'
+
+def random_string():
+    return "".join(random.choices(alphabet, k = random.choice([0, 1, 5, 20, 300])))
+
+def random_value(depth = 0):
+    kind = random.randint(0, 4 if depth < 4 else 1)
+    if kind == 0:
+        return random_string()
+    elif kind == 1:
+        return random.choice([0, -1, 1, 42, -(2 ** 70), 2 ** 64])
+    elif kind == 2:
+        return [random_value(depth + 1) for _ in range(random.randint(0, 5))]
+    else:
+        return {random_string(): random_value(depth + 1) for _ in range(random.randint(0, 5))}
+
+def test_bencode():
+    tests = 0
+    failed = 0
+    for _ in range(10000):
+        tests += 1
+        msgs = [random_value() for _ in range(random.randint(1, 3))]
+        expected = b''.join(reference_encode(msg) for msg in msgs)
+        actual = b''.join(cs_bencode.encode(msg) for msg in msgs)
+        decoded = []
+        decoder = cs_bencode.Decoder()
+        pos = 0
+        while pos < len(actual):
+            end = pos + random.choice([1, 2, 7, 100, 10000])
+            decoded += decoder.feed(actual[pos:end])
+            pos = end
+        if actual != expected or decoded != msgs or reference_decode(expected) != msgs or list(cs_bencode.decode(actual)) != msgs:
+            failed += 1
+            if failed == 1:
+                test_core.print_table(["Value", "Expected", "Actual"], [repr(msgs), repr(expected), repr(actual)])
+    print("Bencode round-trip tests: {}, failed: {}\n".format(tests, failed), flush=True)
+
+def truncate(x, max_string):
+    """
+    What Decoder(max_string) should return for x, with truncated strings as (prefix, size)
+    """
+    if isinstance(x, str):
+        b = x.encode('utf-8')
+        return (b[:max_string].decode('utf-8', 'ignore'), len(b)) if len(b) > max_string else x
+    elif isinstance(x, list):
+        return [truncate(v, max_string) for v in x]
+    elif isinstance(x, dict):
+        return {truncate(k, max_string): truncate(v, max_string) for k, v in x.items()}
+    return x
+
+def short_keys(x):
+    """
+    Truncated keys might collide, real messages have short keys anyway
+    """
+    if isinstance(x, list):
+        return [short_keys(v) for v in x]
+    elif isinstance(x, dict):
+        return {str(i): short_keys(v) for i, v in enumerate(x.values())}
+    return x
+
+def unwrap(x):
+    if isinstance(x, cs_bencode.Truncated):
+        return (str(x), x.size)
+    elif isinstance(x, list):
+        return [unwrap(v) for v in x]
+    elif isinstance(x, dict):
+        return {unwrap(k): unwrap(v) for k, v in x.items()}
+    return x
+
+def test_truncation():
+    tests = 0
+    failed = 0
+    for _ in range(10000):
+        tests += 1
+        max_string = random.choice([1, 5, 50])
+        msgs = [short_keys(random_value()) for _ in range(random.randint(1, 3))]
+        encoded = b''.join(cs_bencode.encode(msg) for msg in msgs)
+        decoded = []
+        decoder = cs_bencode.Decoder(max_string = max_string)
+        pos = 0
+        while pos < len(encoded):
+            end = pos + random.choice([1, 2, 7, 100, 10000])
+            decoded += decoder.feed(encoded[pos:end])
+            pos = end
+        expected = [truncate(msg, max_string) for msg in msgs]
+        if [unwrap(msg) for msg in decoded] != expected or len(decoder.buffer) > 0:
+            failed += 1
+            if failed == 1:
+                test_core.print_table(["Value", "Expected", "Actual"], [repr(msgs), repr(expected), repr([unwrap(msg) for msg in decoded])])
+    print("Bencode truncation tests: {}, failed: {}\n".format(tests, failed), flush=True)
+
+def test_oversized():
+    """
+    on_oversized fires with keys before the long string, while most of it is still to arrive
+    """
+    tests = 0
+    failed = 0
+    for chunk in [1, 7, 100, 4096]:
+        tests += 1
+        msg = {'id': 7, 'session': 'abc', 'status': ['done'], 'value': 'x' * 100000}
+        encoded = cs_bencode.encode(msg)
+        calls = []
+        decoder = cs_bencode.Decoder(max_string = 50, on_oversized = lambda head: calls.append((head, pos)))
+        decoded = []
+        pos = 0
+        while pos < len(encoded):
+            pos += chunk
+            decoded += decoder.feed(encoded[pos - chunk:pos])
+        head = {'id': 7, 'session': 'abc', 'status': ['done']}
+        if [h for h, _ in calls] != [head] or calls[0][1] > 10000 or [unwrap(m) for m in decoded] != [truncate(msg, 50)]:
+            failed += 1
+            if failed == 1:
+                test_core.print_table(["Chunk", "Calls"], [repr(chunk), repr(calls)])
+    print("Bencode oversized tests: {}, failed: {}\n".format(tests, failed), flush=True)
+
+if __name__ == '__main__':
+    test_bencode()
+    test_truncation()
+    test_oversized()
@@ -1,5 +1,5 @@
 #! /usr/bin/env python3
-import os, random, sys, time
+import os, random, re, sys, time
 
 cwd = os.path.dirname(__file__)
 os.chdir(os.path.abspath(cwd + "/.."))
@@ -53,7 +53,146 @@ def test_random():
                 test_core.print_table(["Expr", "Expected", "Actual"], [expr, "(source 0..{})".format(len(expr)), actual])
     print("Randomized tests: {}, failed: {}\n".format(tests, failed), flush=True)
 
+def test_incremental():
+    alphabet = r'019`~!@#$%^&*()_+-=[]{}\\|;:\'",.<>/?aAeEmMnNxXzZ \n'
+    dir = cwd + "/../test_parser/"
+    exprs = []
+    for file in sorted(os.listdir(dir)):
+        with open(dir + file) as f:
+            content = f.read()
+        if file.endswith(".txt"):
+            exprs += [m.group(1) for m in re.finditer("={80}\n.+\n={80}\n\n((?:.+\n)+)\n-{80}", content)]
+        elif file == 'core_deftype.clj':
+            exprs.append(content)
+    exprs += ["".join(random.choices(alphabet, k = random.randint(1, 50))) for _ in range(1000)]
+    tests = 0
+    failed = 0
+    for expr in exprs:
+        for _ in range(10 if len(expr) < 1000 else 3):
+            tests += 1
+            start = random.randint(0, len(expr))
+            old_end = random.randint(start, min(len(expr), start + 10))
+            insert = "".join(random.choices(alphabet, k = random.randint(0, 5)))
+            new = expr[:start] + insert + expr[old_end:]
+            actual = str(cs_parser.reparse(cs_parser.parse(expr), expr, new, start, old_end, start + len(insert)))
+            expected = str(cs_parser.parse(new))
+            if actual != expected:
+                failed += 1
+                if failed == 1:
+                    test_core.print_table(["Old", "New", "Expected", "Actual"], [expr, new, expected, actual])
+            range_ = cs_parser.edit_range(expr, new)
+            if expr[:range_[0]] + new[range_[0]:range_[2]] + expr[range_[1]:] != new:
+                failed += 1
+    print("Incremental tests: {}, failed: {}\n".format(tests, failed), flush=True)
+
+def test_engines():
+    alphabet = r'019`~!@#$%^&*()_+-=[]{}\\|;:\'",.<>/?aAeEmMnNxXzZ \n'
+    dir = cwd + "/../test_parser/"
+    exprs = []
+    for file in sorted(os.listdir(dir)):
+        with open(dir + file) as f:
+            exprs.append(f.read())
+    exprs += ["".join(random.choices(alphabet, k = random.randint(1, 50))) for _ in range(10000)]
+    tests = 0
+    failed = 0
+    for expr in exprs:
+        tests += 1
+        cs_parser.engine = 'combinators'
+        expected = str(cs_parser.parse(expr))
+        cs_parser.engine = 'scanner'
+        actual = str(cs_parser.parse(expr))
+        if actual != expected:
+            failed += 1
+            if failed == 1:
+                test_core.print_table(["Expr", "Expected", "Actual"], [expr, expected, actual])
+    cs_parser.engine = 'combinators'
+    print("Scanner vs combinators: {}, failed: {}\n".format(tests, failed), flush=True)
+
+def test_deep():
+    depth = 10000
+    exprs = ['[' * depth + ']' * depth,
+             '[' * depth,
+             '{:a ' * depth + '}' * depth,
+             "#tag ^:m '" * depth + 'x',
+             '[' * depth + ']' * depth + ' (+ 1 2)']
+    tests = 0
+    failed = 0
+    for engine in ['scanner', 'combinators']:
+        cs_parser.engine = engine
+        for expr in exprs:
+            tests += 1
+            parsed = cs_parser.parse(expr)
+            # walk iteratively, str() would blow up the stack
+            max_depth = 0
+            stack = [(parsed, 0)]
+            while stack:
+                node, node_depth = stack.pop()
+                max_depth = max(max_depth, node_depth)
+                stack.extend((child, node_depth + 1) for child in node.children)
+            if parsed.end < len(expr) or max_depth < depth:
+                failed += 1
+                print("Deep {} '{}...' failed, parsed {}..{}, depth {}".format(engine, expr[:20], parsed.start, parsed.end, max_depth))
+    cs_parser.engine = 'combinators'
+    print("Deep nesting tests: {}, failed: {}\n".format(tests, failed), flush=True)
+
+def test_form_hash():
+    tests = 0
+    failed = 0
+    cases = [('(defn f [x] (+ x 1))', '(defn f [x] (+ x 2))', True),
+             ('(defn f [x] (+ x 1))', '(defn g [x] (+ x 1))', False),
+             ('(println 1)',          '(println 2)',          False),
+             ('[1 2]',                '[1 3]',                False),
+             ('{:a 1}',               '{:a 2}',               False),
+             ('(defmethod area :circle [s] 1)', '(defmethod area :circle [s] 2)', True),
+             ('(defmethod area :circle [s] 1)', '(defmethod area :square [s] 1)', False),
+             ('(defmulti area :shape)',         '(defmethod area :shape [s] 1)',  False),
+             ('(defmulti area :shape)',         '(defmulti area :kind)',          True)]
+    for before, after, same_key in cases:
+        tests += 1
+        for engine in ['scanner', 'combinators']:
+            cs_parser.engine = engine
+            old_key, old_hash = cs_parser.form_hash(cs_parser.parse(before).children[0], before)
+            text = ' ' + after
+            new_key, new_hash = cs_parser.form_hash(cs_parser.parse(text).children[0], text)
+            unchanged_key, unchanged_hash = cs_parser.form_hash(cs_parser.parse(' ' + before).children[0], ' ' + before)
+            if old_hash == new_hash or (old_key == new_key) != same_key or (old_key, old_hash) != (unchanged_key, unchanged_hash):
+                failed += 1
+                print("Form hash failed: '{}' -> '{}' ({})".format(before, after, engine))
+                break
+    cs_parser.engine = 'combinators'
+    print("Form hash tests: {}, failed: {}\n".format(tests, failed), flush=True)
+
+def random_message():
+    def random_string():
+        return '"' + "".join(random.choices(['a', ' ', '\\"', '\\\\', '\\n', '\\t', '\\u', '\n', 'é', '{', '}'], k = random.randint(0, 20))) + '"'
+    def random_value():
+        return random.choice([random_string, lambda: str(random.randint(-1000, 1000)), lambda: random.choice(['nil', 'true', 'false', ':kw', ':ns/kw', '1.5', '1N', '[1 2]', '{"a" "b"}', 'sym'])])()
+    pairs = [random_string() + random.choice([' ', ', ', '\n']) + random_value() for _ in range(random.randint(0, 8))]
+    return '{' + random.choice([' ', ', ']).join(pairs) + '}'
+
+def test_read_message():
+    tests = 0
+    failed = 0
+    for _ in range(10000):
+        tests += 1
+        message = random_message()
+        try:
+            expected = cs_parser.parse_as_dict(message)
+        except Exception:
+            continue
+        actual = cs_parser.read_message(message)
+        if actual != expected:
+            failed += 1
+            if failed == 1:
+                test_core.print_table(["Message", "Expected", "Actual"], [message, repr(expected), repr(actual)])
+    print("Message reader tests: {}, failed: {}\n".format(tests, failed), flush=True)
+
 if __name__ == '__main__':
     test_parse_trees()
     test_clojure()
     test_random()
+    test_incremental()
+    test_engines()
+    test_deep()
+    test_form_hash()
+    test_read_message()
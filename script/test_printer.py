@@ -1,5 +1,5 @@
 #! /usr/bin/env python3
-import os, sys
+import os, random, re, sys
 
 cwd = os.path.dirname(__file__)
 os.chdir(os.path.abspath(cwd + "/.."))
@@ -7,6 +7,132 @@ sys.path.append(os.getcwd())
 import cs_parser, cs_printer
 import script.test_core as test_core
 
+# Reference printer: re-measuring, string-concatenating implementation
+# cs_printer started from. Faster printer must produce the same text
+
+def reference_safe_get(l, i, default = None):
+    """
+    Like dict.get(), but for lists
+    """
+    if i < len(l):
+        return l[i]
+    else:
+        return default
+
+def reference_format_map(text, node, indent, limit):
+    """
+    Puts key-value pairs on separate line each. Aligns keys by longest one:
+    {:a 1 :bbb 2 :cc 3} => {:a   1
+                            :bbb 2
+                            :cc  3}
+    """
+    res = node.open.text
+    indent_keys = indent + len(node.open.text) * ' '
+    keys = []
+    vals = []
+    if node.body:
+        idxs = range(0, len(node.body.children), 2)
+        keys = [node.body.children[i] for i in idxs]
+        vals = [reference_safe_get(node.body.children, i + 1) for i in idxs]
+    key_strings = [reference_format(text, k, indent_keys, limit) for k in keys]
+    longest_key = max(len(ks) for ks in key_strings) if key_strings else 0
+    indent_vals = indent_keys + longest_key * ' ' + ' '
+    for i, ks, v in zip(range(0, len(keys)), key_strings, vals):
+        if i > 0:
+            res += '\n' + indent_keys
+        res += ks
+        if v is not None:
+            vs = reference_format(text, v, indent_keys, limit)
+            if '\n' in vs:
+                res += '\n' + indent_keys + vs
+            elif len(indent_keys) + longest_key + 1 + len(vs) <= limit:
+                res += (longest_key - len(ks)) * ' ' + ' ' + vs
+            elif len(indent_keys) + len(ks) + 1 + len(vs) <= limit:
+                res += ' ' + vs
+            else:
+                res += '\n' + indent_keys + vs
+    if node.close:
+        res += node.close.text
+    return res
+
+def reference_format_list(text, node, indent, limit):
+    """
+    Everythin list-like: (...), [...], #{...}
+    Puts as many children as it can on a line, then starts new one.
+    """
+    indent_children = indent + (len(node.open.text) * ' ')
+    res = node.open.text
+    force_newline = False
+    is_first = True
+    if node.body:
+        for i, child in enumerate(node.body.children):
+            if force_newline:
+                res += '\n' + indent_children
+                is_first = True
+            
+            child_str = reference_format(text, child, indent_children, limit)
+            if '\n' in child_str or child.name in {'brackets', 'parens', 'braces'} or len(child_str) > limit / 3:
+                if not is_first:
+                    res += '\n' + indent_children
+                res += child_str
+                force_newline = True
+                is_first = True
+                continue
+            last_line = res[res.rfind('\n') + 1:]
+            separator = '' if is_first else ' '
+            if len(last_line) + len(separator) + len(child_str) > limit:
+                res += '\n' + indent_children + child_str
+            else:
+                res += separator + child_str
+            force_newline = False
+            is_first = False
+    close = node.close.text if node.close else ''
+    res += close
+    return res
+
+def reference_format_tagged(text, node, indent, limit):
+    """
+    #tag <some_value>
+    """
+    tag_string = reference_format(text, node.tag, indent, limit)
+    res = '#' + tag_string
+    if node.body:
+        value_indent = indent + ' ' + len(tag_string) * ' ' + ' '
+        res += ' ' + reference_format(text, node.body.children[0], value_indent, limit)
+    return res
+
+def reference_format(text, node, indent = '', limit = 80):
+    """
+    Given text and its parsed AST as node, returns formatted (pretty-printed) string of that node
+    """
+    if node.name == 'source':
+        return '\n'.join(reference_format(text, n, '', limit) for n in node.children)
+    elif node.name == 'braces' and node.open.text != '#{':
+        return reference_format_map(text, node, indent, limit)
+    elif node.name in {'parens', 'brackets', 'braces'}:
+        return reference_format_list(text, node, indent, limit)
+    elif node.name == 'tagged':
+        return reference_format_tagged(text, node, indent, limit)
+    else:
+        str = text[node.start:node.end]
+        str = re.sub("(?<!\\\\)\\\\n", "\n", str)
+        str = "\n".join(cs_printer.wrap_string(s, limit = limit, indent = indent) for s in str.split("\n"))
+        return str
+
+def random_form(depth = 0):
+    """
+    Random EDN-ish text, including wide collections, long tokens and unbalanced parens
+    """
+    r = random.random()
+    if depth > 3 or r < 0.4:
+        return random.choice([':a', ':bbb', '1', '12345', 'nil', '"str"', '"line\\nbreak"', '"' + 'x' * random.randint(0, 100) + '"', 'sym/name', '#inst "2020"', '#\'v'])
+    open, close = random.choice([('(', ')'), ('[', ']'), ('{', '}'), ('#{', '}'), ('#:ns{', '}')])
+    children = [random_form(depth + 1) for _ in range(random.randint(0, 8))]
+    tag = '#user.Rec ' if random.random() < 0.1 else ''
+    if random.random() < 0.02:
+        close = ''
+    return tag + open + ' '.join(children) + close
+
 def test_printer():
     dir = cwd + "/../test_printer/"
     def test_fn(input):
@@ -14,5 +140,60 @@ def test_printer():
         return cs_printer.format(input, node)
     test_core.run_tests(dir, test_fn, col_input = False)
 
+def test_reference():
+    tests = 3000
+    failed = 0
+    for _ in range(tests):
+        input = random_form()
+        limit = random.randint(10, 120)
+        node = cs_parser.parse(input)
+        expected = reference_format(input, node, limit = limit)
+        actual = cs_printer.format(input, node, limit = limit)
+        if expected != actual:
+            failed += 1
+            if failed <= 3:
+                test_core.print_table(["Expected (limit {})".format(limit), "Actual"], [expected, actual])
+    print("Reference printer tests: {}, failed: {}\n".format(tests, failed), flush=True)
+
+def random_chunks(input):
+    cuts = sorted(random.randint(0, len(input)) for _ in range(random.randint(0, 10)))
+    return [input[a:b] for a, b in zip([0] + cuts, cuts + [len(input)])]
+
+def test_stream():
+    # Streaming gives the same text as formatting whole input
+    dir = cwd + "/../test_printer/"
+    def test_fn(input):
+        return '\n'.join(cs_printer.format_lines(random_chunks(input)))
+    test_core.run_tests(dir, test_fn, col_input = False)
+
+    tests = 0
+    failed = 0
+    junk = ['', "'", '#', '^', '#_', '@', '~@', '#tag', ')', ']', '}', ';c\n', '"', '\\', '#?(', '#:ns']
+    for _ in range(3000):
+        tests += 1
+        input = ' '.join(random.choice(junk) + random_form() for _ in range(random.randint(1, 3)))
+        limit = random.randint(10, 120)
+        expected = cs_printer.format(input, cs_parser.parse(input), limit = limit)
+        actual = '\n'.join(cs_printer.format_lines(random_chunks(input), limit = limit))
+        if expected != actual:
+            failed += 1
+            if failed <= 3:
+                test_core.print_table(["Input (limit {})".format(limit), "Expected", "Actual"], [input, expected, actual])
+
+    tests += 1
+    input = '[' * 10000 + ']' * 10000
+    if '\n'.join(cs_printer.format_lines([input])) != cs_printer.format_value(input, cs_parser.parse(input)):
+        failed += 1
+    print("Stream printer tests: {}, failed: {}\n".format(tests, failed), flush=True)
+
+def test_deep():
+    input = '[' * 10000 + ']' * 10000
+    node = cs_parser.parse(input)
+    failed = 0 if cs_printer.format_value(input, node) == input else 1
+    print("Deep nesting tests: 1, failed: {}\n".format(failed), flush=True)
+
 if __name__ == '__main__':
     test_printer()
+    test_reference()
+    test_stream()
+    test_deep()
@@ -0,0 +1,67 @@
+#! /usr/bin/env python3
+import os, random, sys
+
+cwd = os.path.dirname(__file__)
+os.chdir(os.path.abspath(cwd + "/.."))
+sys.path.append(os.getcwd())
+import sublime
+import cs_common
+
+class Item:
+    def __init__(self, key):
+        self.key = key
+
+    def region_key(self):
+        return self.key
+
+class View:
+    """
+    Keeps regions the way Sublime does: points at or after changed range move
+    by delta, points inside it collapse to its start
+    """
+    def __init__(self):
+        self.regions = {}
+
+    def get_regions(self, key):
+        return [sublime.Region(*self.regions[key])] if key in self.regions else []
+
+    def change(self, a, b, delta):
+        move = lambda p: p + delta if p >= b else a if p > a else p
+        for key, (begin, end) in self.regions.items():
+            self.regions[key] = (move(begin), move(end))
+
+def test_regions():
+    tests = 0
+    failed = 0
+    for _ in range(10000):
+        tests += 1
+        view = View()
+        index = cs_common.RegionIndex()
+        pos = 0
+        for key in range(random.randint(0, 12)):
+            begin = pos + random.randint(0, 5)
+            pos = begin + random.randint(0, 6)
+            view.regions[key] = (begin, pos)
+            index.add(Item(key), sublime.Region(begin, pos))
+        changes = []
+        for _ in range(random.randint(1, 3)):
+            a = random.randint(0, pos + 3)
+            b = a + random.randint(0, 4)
+            delta = random.randint(0, 4) - (b - a)
+            changes.append((a, b, delta))
+            view.change(a, b, delta)
+        index.shift(view, changes)
+        q = random.randint(0, pos)
+        query = sublime.Region(q, q + random.randint(0, 3))
+        expected = sorted(key for key, (begin, end) in view.regions.items() if cs_common.regions_touch(sublime.Region(begin, end), query))
+        actual = sorted(item.key for item, _ in index.find(query))
+        regions = {item.key: (region.begin(), region.end()) for item, region in index.regions()}
+        lookups = {item.key: (region.begin(), region.end()) for item, _ in index.regions() if (region := index.region(item)) is not None}
+        if regions != view.regions or lookups != regions or actual != expected or index.begins != sorted(index.begins) or index.ends != sorted(index.ends):
+            failed += 1
+            if failed == 1:
+                print("Changes:", changes, "Expected:", view.regions, expected, "Actual:", regions, actual)
+    print("Region index tests: {}, failed: {}\n".format(tests, failed), flush=True)
+
+if __name__ == '__main__':
+    test_regions()
@@ -0,0 +1,78 @@
+#! /usr/bin/env python3
+import importlib, os, random, sys
+
+dir = os.path.abspath(os.path.dirname(__file__) + "/..")
+module = os.path.basename(dir)
+sys.path.append(os.path.abspath(dir + "/.."))
+sys.path.append(dir + "/script")
+
+cs_conn_socket_repl = importlib.import_module(module + '.cs_conn_socket_repl')
+test_core = importlib.import_module(module + '.script.test_core')
+
+def test_lines():
+    """
+    Line over max_line is dropped up to next newline and reported once,
+    lines around it are delivered intact, however input is chunked.
+    Overflow is reported as soon as line goes over max_line
+    """
+    tests = 0
+    failed = 0
+    for _ in range(1000):
+        tests += 1
+        max_line = random.choice([1, 10, 100])
+        long = 'x' * random.randint(max_line + 1, max_line * 50)
+        text = 'short\n' + long + '\nnext line\n'
+        expected = [line for line in text.split('\n')[:-1] if len(line) <= max_line]
+        lines = []
+        reports = []
+        events = []
+        reader = cs_conn_socket_repl.Lines(max_line = max_line,
+                                           on_oversized = lambda head, size: (reports.append((head, size)), events.append('oversized')),
+                                           on_overflow = lambda head: events.append(head))
+        data = text.encode()
+        pos = 0
+        while pos < len(data):
+            end = pos + random.choice([1, 2, 7, 100, 10000])
+            lines += reader.feed(data[pos:end])
+            pos = end
+        lines += reader.close()
+        expected_reports = [(line.encode()[:max_line], len(line)) for line in text.split('\n')[:-1] if len(line) > max_line]
+        expected_events = [event for head, _ in expected_reports for event in (head, 'oversized')]
+        if lines != expected or reports != expected_reports or events != expected_events:
+            failed += 1
+            if failed == 1:
+                test_core.print_table(["Max line", "Expected", "Actual"], [repr(max_line), repr((expected, expected_reports)), repr((lines, reports, events))])
+    print("Lines tests: {}, failed: {}\n".format(tests, failed), flush=True)
+
+def test_overflow():
+    """
+    Overflow is reported before the rest of oversized message arrives
+    """
+    tests = 0
+    failed = 0
+
+    tests += 1
+    heads = []
+    reader = cs_conn_socket_repl.Lines(max_line = 10, on_overflow = heads.append)
+    reader.feed(b'{"id" 5, "val" "')
+    if heads != [b'{"id" 5, "'] or reader.feed(b'x' * 1000) != []:
+        failed += 1
+        print("Lines overflow:", heads)
+
+    tests += 1
+    headers = []
+    reader = cs_conn_socket_repl.Frames(max_field = 10, on_overflow = headers.append)
+    reader.feed('{"tag" "started"}\n{"id" 5, "tag" "ret", "payload" "val 1000"}\n'.encode())
+    if [header.get('id') for header in headers] != [5]:
+        failed += 1
+        print("Frames overflow:", headers)
+    msgs = reader.feed(b'x' * 1000)
+    if [(msg['val'], msg['truncated']) for msg in msgs] != [('x' * 10, ['val'])] or len(headers) != 1:
+        failed += 1
+        print("Frames overflow:", msgs, headers)
+
+    print("Overflow tests: {}, failed: {}\n".format(tests, failed), flush=True)
+
+if __name__ == '__main__':
+    test_lines()
+    test_overflow()
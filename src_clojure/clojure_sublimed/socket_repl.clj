@@ -206,35 +206,63 @@
                  *print-readably* true]
          (prn (merge (sorted-map) (some-> *context* deref) %))))))
 
-(defn repl []
-  (let [out-fn (out-fn *out*)]
-    (try
-      (swap! *out-fns conj out-fn)
-      (binding [*out-fn* out-fn
-                *out*    (core/duplicate-writer (.getRawRoot #'*out*) "out" out-fn)
-                *err*    (core/duplicate-writer (.getRawRoot #'*err*) "err" out-fn)
-                core/*changed-vars (atom {})]
-        (out-fn {"tag" "started"})
-        (loop []
-          (when
-            (binding [*context* (volatile! {})]
-              (try
-                (let [form (read-command *in*)]
-                  (core/set-changed-vars!)
-                  (when-some [id (form "id")]
-                    (vswap! *context* assoc "id" id))
-                  (case (get form "op")
-                    "eval"      (fork-eval form)
-                    "interrupt" (interrupt form)
-                    "lookup"    (lookup-symbol form)
-                    (throw (Exception. (str "Unknown op: " (get form "op")))))
-                  true)
-                (catch Throwable t
-                  (when-not (-> t ex-data ::stop)
-                    (report-throwable t)
-                    true))))
-            (recur)))
-        (doseq [[id f] @*evals]
-          (future-cancel f)))
-      (finally
-        (swap! *out-fns disj out-fn)))))
+(defn framed-out-fn
+  "Opt-in framing: string fields other than \"tag\" are written raw after EDN header line.
+   Header lists them with lengths in code points, e.g. \"payload\" \"val 3 form 7\""
+  [^Writer out]
+  (let [lock (Object.)]
+    #(locking lock
+       (let [msg     (merge (sorted-map) (some-> *context* deref) %)
+             payload (for [[k v] msg
+                           :when (and (string? v) (not= "tag" k))]
+                       [k v])
+             header  (cond-> (apply dissoc msg (map first payload))
+                       (seq payload)
+                       (assoc "payload" (str/join " "
+                                          (for [[k ^String v] payload]
+                                            (str k " " (.codePointCount v 0 (.length v)))))))]
+         (binding [*out*            out
+                   *print-readably* true]
+           (prn header))
+         (doseq [[_ ^String v] payload]
+           (.write out v))
+         (.flush out)))))
+
+(defn repl
+  "Upgrades socket REPL. Pass {\"framing\" \"length\"} to get framed-out-fn instead of plain EDN"
+  ([]
+   (repl nil))
+  ([opts]
+   (let [out-fn (if (= "length" (get opts "framing"))
+                  (framed-out-fn *out*)
+                  (out-fn *out*))]
+     (try
+       (swap! *out-fns conj out-fn)
+       (binding [*out-fn* out-fn
+                 *out*    (core/duplicate-writer (.getRawRoot #'*out*) "out" out-fn)
+                 *err*    (core/duplicate-writer (.getRawRoot #'*err*) "err" out-fn)
+                 core/*changed-vars (atom {})]
+         (out-fn {"tag" "started"})
+         (loop []
+           (when
+             (binding [*context* (volatile! {})]
+               (try
+                 (let [form (read-command *in*)]
+                   (core/set-changed-vars!)
+                   (when-some [id (form "id")]
+                     (vswap! *context* assoc "id" id))
+                   (case (get form "op")
+                     "eval"      (fork-eval form)
+                     "interrupt" (interrupt form)
+                     "lookup"    (lookup-symbol form)
+                     (throw (Exception. (str "Unknown op: " (get form "op")))))
+                   true)
+                 (catch Throwable t
+                   (when-not (-> t ex-data ::stop)
+                     (report-throwable t)
+                     true))))
+             (recur)))
+         (doseq [[id f] @*evals]
+           (future-cancel f)))
+       (finally
+         (swap! *out-fns disj out-fn))))))